@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", str(24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "512"))
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_answer_cache(cache_dir, embeddings):
+    """Return the process-wide AnswerCache stored under cache_dir"""
+    db_path = Path(cache_dir) / "answer_cache.sqlite"
+    with _caches_lock:
+        if db_path not in _caches:
+            _caches[db_path] = AnswerCache(db_path, embeddings)
+        return _caches[db_path]
+
+def clear_answer_cache(cache_dir):
+    """Delete every answer cached under cache_dir, from this process's memory tier and from disk; returns bytes freed"""
+    db_path = Path(cache_dir) / "answer_cache.sqlite"
+    with _caches_lock:
+        cache = _caches.get(db_path)
+    try:
+        size = db_path.stat().st_size
+    except OSError:
+        return 0
+    if cache is not None:
+        cache.clear()
+    else:
+        db = sqlite3.connect(str(db_path))
+        try:
+            with db:
+                db.execute("DELETE FROM answers")
+            db.execute("VACUUM")
+        except sqlite3.Error:
+            pass
+        finally:
+            db.close()
+    return max(size - db_path.stat().st_size, 0)
+
+def document_set_key(file_hashes, selected_files=None, settings=None):
+    """
+    Identify the documents an answer was produced from, independent of upload order.
+    settings (e.g. the retrieval k, weights and fusion) are part of the key when given.
+    """
+    parts = sorted(set(file_hashes or [])) + ["|"] + sorted(selected_files or [])
+    if settings:
+        parts += ["|", json.dumps(settings, sort_keys=True)]
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+class AnswerCache:
+    """
+    Two-tier answer cache keyed by document set and question.
+    An exact (normalized) question match is a dictionary lookup; otherwise the question
+    embedding is compared with the cached questions for the same document set and the
+    closest one is used if its cosine similarity reaches the threshold.
+    The memory tier is an LRU with a TTL; every entry is also written to SQLite, which keeps
+    the newest max_entries per document set, so answers survive restarts and exact matches
+    are shared between worker processes.
+    """
+
+    def __init__(self, db_path, embeddings, threshold=ANSWER_CACHE_THRESHOLD,
+                 ttl=ANSWER_CACHE_TTL_SECONDS, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (docset, normalized question) -> (vector, answer, created)
+        self.loaded_docsets = set()
+        self.hits = self.near_hits = self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS answers (
+                docset TEXT, question TEXT, vector BLOB, answer TEXT, created REAL,
+                PRIMARY KEY (docset, question))""")
+            self.db.execute("DELETE FROM answers WHERE created < ?", (time.time() - self.ttl,))
+
+    def _load_docset(self, docset):
+        """Pull the most recent unexpired disk entries for a document set into memory"""
+        rows = self.db.execute(
+            "SELECT question, vector, answer, created FROM answers WHERE docset = ? AND created >= ? "
+            "ORDER BY created DESC LIMIT ?", (docset, time.time() - self.ttl, self.max_entries)).fetchall()
+        for question, vector, answer, created in reversed(rows):
+            self._remember((docset, question), np.frombuffer(vector, dtype=np.float32), answer, created)
+        self.loaded_docsets.add(docset)
+
+    def _remember(self, key, vector, answer, created):
+        self.entries[key] = (vector, answer, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _embed(self, question):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, docset, question):
+        """
+        Return (answer, vector). answer is None on a miss; vector is the normalized
+        question embedding (or None on an exact hit) and can be passed back to store().
+        """
+        key = (docset, normalize_question(question))
+        now = time.time()
+        with self.lock:
+            if docset not in self.loaded_docsets:
+                self._load_docset(docset)
+            entry = self.entries.get(key)
+            if entry is None:
+                row = self.db.execute("SELECT vector, answer, created FROM answers WHERE docset = ? AND question = ?",
+                                      key).fetchone()
+                if row is not None:
+                    entry = (np.frombuffer(row[0], dtype=np.float32), row[1], row[2])
+                    self._remember(key, *entry)
+            if entry is not None and now - entry[2] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], None
+            candidates = [(k, e) for k, e in self.entries.items() if k[0] == docset and now - e[2] <= self.ttl]
+
+        vector = self._embed(question)
+        if candidates:
+            similarities = np.stack([e[0] for _, e in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                with self.lock:
+                    best_key = candidates[best][0]
+                    if best_key in self.entries:
+                        self.entries.move_to_end(best_key)
+                    self.hits += 1
+                    self.near_hits += 1
+                return candidates[best][1][1], vector
+        with self.lock:
+            self.misses += 1
+        return None, vector
+
+    def store(self, docset, question, answer, vector=None):
+        key = (docset, normalize_question(question))
+        if vector is None:
+            vector = self._embed(question)
+        created = time.time()
+        with self.lock:
+            self._remember(key, vector, answer, created)
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                                (docset, key[1], vector.astype(np.float32).tobytes(), answer, created))
+                # The disk tier keeps the same number of answers per document set as the memory tier does overall
+                self.db.execute("DELETE FROM answers WHERE docset = ? AND rowid NOT IN "
+                                "(SELECT rowid FROM answers WHERE docset = ? ORDER BY created DESC LIMIT ?)",
+                                (docset, docset, self.max_entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.loaded_docsets.clear()
+            with self.db:
+                self.db.execute("DELETE FROM answers")
+            # Gives the pages back to the file system
+            self.db.execute("VACUUM")
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "near_hits": self.near_hits, "misses": self.misses, "entries": len(self.entries)}
@@ -0,0 +1,251 @@
+"""
+End-to-end benchmark of ingestion, retrieval and Submit latency, without a Groq key.
+
+    python benchmark.py --docs 30 --words 3000 --queries 50 --out benchmarks/run.json --baseline benchmarks/prev.json
+
+A deterministic synthetic corpus of PDF, TXT and CSV files is generated, uploaded through
+load_and_process_documents into fresh directories, and queried through the hybrid retriever
+and refine_question + qa_chain. The LLM is the local FakeChatModel (LLM_BACKEND=fake), so
+LLM time is only the configured --llm-latency; embeddings use the real model. With --llm-server
+the LLM calls instead go over HTTP through llm_client to fake_llm.py's stand-in server.
+Results are written as JSON; with --baseline the relative change of every metric is printed.
+"""
+import os
+os.environ["LLM_BACKEND"] = "fake"
+os.environ.setdefault("FAKE_LLM_LATENCY_SECONDS", "0")
+
+import argparse
+import csv
+import io
+import json
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+from streamlit.runtime.uploaded_file_manager import UploadedFile
+
+def make_vocabulary(rng, size=3000):
+    syllables = ["ka", "lo", "mi", "ren", "sa", "tor", "vi", "den", "pa", "qu", "ar", "el", "is", "on", "ut", "ber"]
+    return sorted({"".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(size)})
+
+def make_sentences(rng, vocabulary, words):
+    sentences, count = [], 0
+    while count < words:
+        length = rng.randint(8, 20)
+        sentences.append(" ".join(rng.choice(vocabulary) for _ in range(length)).capitalize() + ".")
+        count += length
+    return sentences
+
+def write_pdf(path, sentences):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    pdf = canvas.Canvas(str(path), pagesize=letter)
+    lines, line = [], ""
+    for sentence in sentences:
+        for word in sentence.split():
+            if len(line) + len(word) > 90:
+                lines.append(line)
+                line = ""
+            line = f"{line} {word}".strip()
+    lines.append(line)
+    for page_start in range(0, len(lines), 50):
+        text = pdf.beginText(40, 750)
+        for page_line in lines[page_start:page_start + 50]:
+            text.textLine(page_line)
+        pdf.drawText(text)
+        pdf.showPage()
+    pdf.save()
+
+def write_csv(path, rng, vocabulary, words):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "category", "value", "description"])
+        for row in range(max(words // 12, 1)):
+            writer.writerow([row, rng.choice(vocabulary), rng.choice(vocabulary[:20]), round(rng.uniform(0, 1000), 2),
+                             " ".join(rng.choice(vocabulary) for _ in range(8))])
+
+def make_corpus(corpus_dir, docs, words, seed=0):
+    """Write docs synthetic files (cycling PDF, TXT, CSV) of about words words each; returns (paths, vocabulary)"""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(docs):
+        kind = ("pdf", "txt", "csv")[i % 3]
+        path = corpus_dir / f"doc_{i:04d}.{kind}"
+        if kind == "pdf":
+            write_pdf(path, make_sentences(rng, vocabulary, words))
+        elif kind == "txt":
+            path.write_text("\n\n".join(make_sentences(rng, vocabulary, words)), encoding="utf-8")
+        else:
+            write_csv(path, rng, vocabulary, words)
+        paths.append(path)
+    return paths, vocabulary
+
+class BenchUpload(UploadedFile):
+    """An UploadedFile read from disk, so the app sees the same type as a real upload"""
+
+    def __init__(self, path):
+        io.BytesIO.__init__(self, Path(path).read_bytes())
+        self.file_id = self.name = Path(path).name
+        self.type = "application/octet-stream"
+        self.size = len(self.getvalue())
+
+def make_dirs(base_dir):
+    dirs = {"base_dir": base_dir, "temp_dir": base_dir / "temp_files", "cache_dir": base_dir / "cache",
+            "uploads_dir": base_dir / "uploads"}
+    for directory in dirs.values():
+        directory.mkdir(parents=True, exist_ok=True)
+    return dirs
+
+def latency_stats(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {"count": len(ms), "mean_ms": float(ms.mean()), "p50_ms": float(np.percentile(ms, 50)),
+            "p95_ms": float(np.percentile(ms, 95)), "p99_ms": float(np.percentile(ms, 99))}
+
+def peak_rss_mb(who="self"):
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def git_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    from processing import load_and_process_documents, refine_question
+    from embedding_service import get_embedding_service
+
+    rng = random.Random(args.seed + 1)
+    work_dir = Path(tempfile.mkdtemp(prefix="rag_benchmark_"))
+    if args.keep:
+        print(f"Working directory: {work_dir}")
+    paths, vocabulary = make_corpus(work_dir / "corpus", args.docs, args.words, args.seed)
+    uploads = [BenchUpload(p) for p in paths]
+    corpus_bytes = sum(len(u.getvalue()) for u in uploads)
+
+    start = time.perf_counter()
+    get_embedding_service().embed_query("warm up")
+    model_load = time.perf_counter() - start
+
+    dirs = make_dirs(work_dir / "cold")
+    start = time.perf_counter()
+    llm, qa_chain, hybrid_retriever, file_names, chunk_count = load_and_process_documents(uploads, "benchmark", dirs, args.workers)
+    cold = time.perf_counter() - start
+
+    # Same uploads again, as from a second session: documents are cached and the indexes already loaded
+    start = time.perf_counter()
+    load_and_process_documents(uploads, "benchmark", dirs, args.workers)
+    warm = time.perf_counter() - start
+
+    queries = [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(3, 6))) for _ in range(args.queries)]
+    retrieval = []
+    for query in queries:
+        start = time.perf_counter()
+        hybrid_retriever.invoke(query)
+        retrieval.append(time.perf_counter() - start)
+
+    submit = []
+    for query in queries:
+        start = time.perf_counter()
+        refined = refine_question(query, llm, None, file_names)
+        qa_chain({"question": refined})
+        submit.append(time.perf_counter() - start)
+
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "version": git_version(),
+        "timestamp": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "config": {"docs": args.docs, "words_per_doc": args.words, "queries": args.queries, "seed": args.seed,
+                   "workers": args.workers, "llm_latency_seconds": float(os.environ["FAKE_LLM_LATENCY_SECONDS"]),
+                   "llm": "server" if args.llm_server else "fake"},
+        "corpus": {"files": len(uploads), "bytes": corpus_bytes, "chunks": chunk_count},
+        "model_load_seconds": model_load,
+        "ingestion": {"cold_seconds": cold, "cold_docs_per_second": len(uploads) / cold,
+                      "cold_chunks_per_second": chunk_count / cold,
+                      "warm_seconds": warm, "warm_docs_per_second": len(uploads) / warm},
+        "retrieval": latency_stats(retrieval),
+        "submit": latency_stats(submit),
+        "peak_rss_mb": peak_rss_mb(),
+        # Largest ingestion worker process
+        "peak_worker_rss_mb": peak_rss_mb("children")
+    }
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+def compare(results, baseline):
+    previous = dict(flatten(baseline))
+    for name, value in flatten(results):
+        if name.startswith("config.") or not previous.get(name):
+            continue
+        change = (value - previous[name]) / previous[name] * 100
+        print(f"  {name:40s} {previous[name]:12.2f} -> {value:12.2f}  ({change:+.1f}%)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, retrieval and Submit latency with a local fake LLM")
+    parser.add_argument("--docs", type=int, default=30, help="Number of synthetic files, cycling PDF/TXT/CSV")
+    parser.add_argument("--words", type=int, default=3000, help="Approximate words per file")
+    parser.add_argument("--queries", type=int, default=50, help="Queries for the retrieval and Submit measurements")
+    parser.add_argument("--workers", type=int, default=None, help="Ingestion workers (default: one per core)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-latency", type=float, default=None, help="Simulated LLM latency in seconds")
+    parser.add_argument("--llm-server", action="store_true", help="Call a local HTTP stand-in for the LLM API through llm_client")
+    parser.add_argument("--out", type=Path, default=Path("benchmarks") / f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated corpus and indexes (path is printed)")
+    parser.add_argument("--baseline", type=Path, default=None, help="Earlier results JSON to compare against")
+    args = parser.parse_args(argv)
+    if args.llm_latency is not None:
+        os.environ["FAKE_LLM_LATENCY_SECONDS"] = str(args.llm_latency)
+    if args.llm_server:
+        import llm_client
+        import processing
+        from fake_llm import FakeLLMServer
+        server = FakeLLMServer(latency=float(os.environ["FAKE_LLM_LATENCY_SECONDS"])).start()
+        processing.LLM_BACKEND = "groq"
+        llm_client.LLM_BASE_URL = server.url
+        # The stand-in has no quota to protect
+        if "LLM_REQUESTS_PER_MINUTE" not in os.environ:
+            llm_client.LLM_REQUESTS_PER_MINUTE = 1e6
+
+    results = run(args)
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    ingestion = results["ingestion"]
+    print(f"Corpus: {results['corpus']['files']} files, {results['corpus']['chunks']} chunks")
+    print(f"Ingestion: {ingestion['cold_docs_per_second']:.2f} docs/s cold, {ingestion['warm_docs_per_second']:.2f} docs/s cached")
+    for name in ("retrieval", "submit"):
+        stats = results[name]
+        print(f"{name.capitalize()}: p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms")
+    if results["peak_rss_mb"] is not None:
+        print(f"Peak RSS: {results['peak_rss_mb']:.0f} MB")
+    print(f"Results -> {args.out}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            print(f"Compared with {args.baseline}:")
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+class BM25Index:
+    """
+    Okapi BM25 over chunk ids, kept in flat numpy arrays instead of per-document Python lists.
+    Postings are stored doc-major (CSR) so files can be appended or tombstoned in place;
+    a term-major copy used for scoring is rebuilt lazily after each change.
+    """
+
+    def __init__(self, k1=1.5, b=0.75, epsilon=0.25):
+        self.k1, self.b, self.epsilon = k1, b, epsilon
+        self.vocab = {}
+        self.doc_ids = []
+        self.groups = []
+        self.doc_groups = np.zeros(0, dtype=np.int32)
+        self.doc_offsets = np.zeros(1, dtype=np.int64)
+        self.term_ids = np.zeros(0, dtype=np.int32)
+        self.term_freqs = np.zeros(0, dtype=np.float32)
+        self.doc_lengths = np.zeros(0, dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self._postings = None
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def nbytes(self):
+        """Approximate memory use: the arrays, the postings built on first search, and the vocabulary and ids"""
+        arrays = [self.doc_groups, self.doc_offsets, self.term_ids, self.term_freqs, self.doc_lengths, self.alive]
+        # Postings: int64 row + float32 weight per entry, int64 offset + float32 idf per term
+        size = sum(a.nbytes for a in arrays) + 12 * len(self.term_ids) + 12 * len(self.vocab)
+        # Rough per-entry cost of Python strings in dicts and lists
+        return size + 100 * (len(self.vocab) + len(self.doc_ids))
+
+    def group_names(self):
+        alive_groups = np.unique(self.doc_groups[self.alive])
+        return [self.groups[g] for g in alive_groups]
+
+    def add(self, group, ids, texts):
+        """Append the chunks of one file; group is the file hash used for later removal"""
+        if group in self.groups:
+            group_id = self.groups.index(group)
+        else:
+            group_id = len(self.groups)
+            self.groups.append(group)
+        term_ids, term_freqs, lengths = [], [], []
+        for text in texts:
+            tokens = tokenize(text)
+            token_ids = np.fromiter((self.vocab.setdefault(t, len(self.vocab)) for t in tokens), dtype=np.int32, count=len(tokens))
+            unique, counts = np.unique(token_ids, return_counts=True)
+            term_ids.append(unique.astype(np.int32))
+            term_freqs.append(counts.astype(np.float32))
+            lengths.append(len(tokens))
+        if not lengths:
+            return
+        sizes = np.fromiter((len(t) for t in term_ids), dtype=np.int64, count=len(term_ids))
+        self.doc_offsets = np.concatenate([self.doc_offsets, self.doc_offsets[-1] + np.cumsum(sizes)])
+        self.term_ids = np.concatenate([self.term_ids, *term_ids])
+        self.term_freqs = np.concatenate([self.term_freqs, *term_freqs])
+        self.doc_lengths = np.concatenate([self.doc_lengths, np.asarray(lengths, dtype=np.float32)])
+        self.doc_groups = np.concatenate([self.doc_groups, np.full(len(lengths), group_id, dtype=np.int32)])
+        self.alive = np.concatenate([self.alive, np.ones(len(lengths), dtype=bool)])
+        self.doc_ids.extend(ids)
+        self._postings = None
+
+    def remove(self, group):
+        """Tombstone every chunk of one file; the arrays are compacted once enough rows are dead"""
+        if group not in self.groups:
+            return
+        self.alive[self.doc_groups == self.groups.index(group)] = False
+        self._postings = None
+        if (~self.alive).sum() > 0.25 * len(self.alive):
+            self.compact()
+
+    def compact(self):
+        keep = np.flatnonzero(self.alive)
+        sizes = np.diff(self.doc_offsets)[keep]
+        entry_rows = np.repeat(np.arange(len(self.alive)), np.diff(self.doc_offsets))
+        entry_mask = self.alive[entry_rows]
+        self.term_ids = self.term_ids[entry_mask]
+        self.term_freqs = self.term_freqs[entry_mask]
+        self.doc_offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.doc_lengths = self.doc_lengths[keep]
+        self.doc_groups = self.doc_groups[keep]
+        self.doc_ids = [self.doc_ids[i] for i in keep]
+        self.alive = np.ones(len(keep), dtype=bool)
+        self._postings = None
+
+    def _build_postings(self):
+        rows = np.repeat(np.arange(len(self.alive), dtype=np.int64), np.diff(self.doc_offsets))
+        live = self.alive[rows]
+        rows, terms, freqs = rows[live], self.term_ids[live], self.term_freqs[live]
+        order = np.argsort(terms, kind="stable")
+        vocab_size = len(self.vocab)
+        term_offsets = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=vocab_size))]).astype(np.int64)
+
+        n_docs = max(int(self.alive.sum()), 1)
+        df = np.diff(term_offsets).astype(np.float64)
+        idf = np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+        seen = df > 0
+        average_idf = idf[seen].mean() if seen.any() else 0.0
+        idf[idf < 0] = self.epsilon * average_idf
+
+        average_length = self.doc_lengths[self.alive].mean() if self.alive.any() else 1.0
+        doc_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / average_length)
+        post_rows = rows[order]
+        post_freqs = freqs[order]
+        # Per-posting BM25 weight without the idf factor, so a query is a gather plus a scatter-add
+        post_weights = (post_freqs * (self.k1 + 1) / (post_freqs + doc_norm[post_rows])).astype(np.float32)
+        self._postings = (term_offsets, post_rows, post_weights, idf.astype(np.float32))
+
+    def search(self, query, k, groups=None):
+        """
+        Return up to k (chunk_id, score) pairs with a positive score, best first.
+        groups limits scoring to the chunks of those files.
+        """
+        if self._postings is None:
+            self._build_postings()
+        term_offsets, post_rows, post_weights, idf = self._postings
+        query_terms = [self.vocab[t] for t in tokenize(query) if t in self.vocab]
+        if not query_terms:
+            return []
+        query_terms = np.asarray(query_terms, dtype=np.int64)
+        starts, ends = term_offsets[query_terms], term_offsets[query_terms + 1]
+        lengths = ends - starts
+        entries = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+        rows = post_rows[entries]
+        weights = post_weights[entries] * np.repeat(idf[query_terms], lengths)
+        if groups is not None:
+            group_ids = [self.groups.index(g) for g in groups if g in self.groups]
+            keep = np.isin(self.doc_groups[rows], group_ids)
+            rows, weights = rows[keep], weights[keep]
+        scores = np.zeros(len(self.alive), dtype=np.float32)
+        np.add.at(scores, rows, weights)
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(self.doc_ids[i], float(scores[i])) for i in candidates]
+
+    def save(self, path):
+        """Write the index to path atomically: arrays in an .npz, vocabulary and ids as JSON"""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        np.savez(tmp_path / "arrays.npz", doc_offsets=self.doc_offsets, term_ids=self.term_ids,
+                 term_freqs=self.term_freqs, doc_lengths=self.doc_lengths,
+                 doc_groups=self.doc_groups, alive=self.alive)
+        with open(tmp_path / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "epsilon": self.epsilon, "vocab": self.vocab,
+                       "doc_ids": self.doc_ids, "groups": self.groups}, f, ensure_ascii=False)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        with open(path / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(meta["k1"], meta["b"], meta["epsilon"])
+        index.vocab = meta["vocab"]
+        index.doc_ids = meta["doc_ids"]
+        index.groups = meta["groups"]
+        with np.load(path / "arrays.npz") as arrays:
+            for name in ("doc_offsets", "term_ids", "term_freqs", "doc_lengths", "doc_groups", "alive"):
+                setattr(index, name, arrays[name])
+        return index
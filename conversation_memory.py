@@ -0,0 +1,78 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import List
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.schema import BaseMessage
+from metrics import metrics
+
+# Recent turns kept verbatim; older turns are folded into a summary of at most MEMORY_SUMMARY_TOKENS
+MEMORY_TOKEN_BUDGET = int(os.environ.get("MEMORY_TOKEN_BUDGET", "1200"))
+MEMORY_SUMMARY_TOKENS = int(os.environ.get("MEMORY_SUMMARY_TOKENS", "300"))
+SUMMARY_CACHE_SIZE = 256
+
+_summaries = OrderedDict()  # sha1(previous summary, pruned turns) -> new summary
+_summaries_lock = threading.Lock()
+
+def estimate_tokens(text):
+    """About four characters per token; close enough for budgeting and needs no tokenizer"""
+    return len(text) // 4 + 1
+
+def truncate_tokens(text, max_tokens):
+    """Keep the end of text, where a progressive summary holds the most recent turns"""
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return "..." + text[-max_chars:].split(" ", 1)[-1]
+
+class TokenBudgetMemory(ConversationSummaryBufferMemory):
+    """
+    Conversation memory whose size is bounded by tokens rather than by turns.
+    When the verbatim turns exceed max_token_limit, the oldest whole turns are removed
+    until half the budget is left and folded into the running summary with one LLM call,
+    so summarizing happens every few turns rather than on each one. The summary is only
+    ever extended, never rebuilt from the full history, and identical summarization
+    requests are answered from a process-wide cache. The history handed to the
+    condense-question prompt is therefore at most max_token_limit + summary_token_limit
+    (or the latest turn plus the summary, when that single turn is larger than the budget).
+    """
+
+    summary_token_limit: int = MEMORY_SUMMARY_TOKENS
+
+    def message_tokens(self, messages: List[BaseMessage]) -> int:
+        return sum(estimate_tokens(str(message.content)) for message in messages)
+
+    def prune(self) -> None:
+        buffer = self.chat_memory.messages
+        if self.message_tokens(buffer) <= self.max_token_limit:
+            return
+        pruned = []
+        # The latest turn always stays verbatim, however long it is
+        while len(buffer) > 2 and self.message_tokens(buffer) > self.max_token_limit // 2:
+            # Human and AI messages leave together so the window always starts at a question
+            pruned.extend(buffer[:2])
+            del buffer[:2]
+        if not pruned:
+            # Only the latest turn is left: nothing to summarize, and an empty prompt invites a made-up summary
+            return
+        self.moving_summary_buffer = self.summarize(pruned)
+
+    def summarize(self, pruned: List[BaseMessage]) -> str:
+        key = hashlib.sha1("\x00".join([self.moving_summary_buffer] + [f"{m.type}:{m.content}" for m in pruned])
+                           .encode("utf-8")).hexdigest()
+        with _summaries_lock:
+            summary = _summaries.get(key)
+            if summary is not None:
+                _summaries.move_to_end(key)
+                metrics.increment("memory_summaries_total", source="cache")
+                return summary
+        with metrics.span("memory.summarize"):
+            summary = truncate_tokens(self.predict_new_summary(pruned, self.moving_summary_buffer).strip(),
+                                      self.summary_token_limit)
+        metrics.increment("memory_summaries_total", source="llm")
+        with _summaries_lock:
+            _summaries[key] = summary
+            while len(_summaries) > SUMMARY_CACHE_SIZE:
+                _summaries.popitem(last=False)
+        return summary
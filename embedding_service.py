@@ -0,0 +1,104 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from langchain.embeddings.base import Embeddings
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# "default" runs the model as shipped; "int8" applies dynamic int8 quantization to its Linear layers
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "default")
+MAX_BATCH_SIZE = 64
+BATCH_WAIT_SECONDS = 0.005
+
+_services = {}
+_services_lock = threading.Lock()
+
+def get_embedding_service(model_name=EMBEDDING_MODEL, backend=None):
+    """Return the process-wide EmbeddingService for a model, shared by every session"""
+    backend = backend or EMBEDDING_BACKEND
+    with _services_lock:
+        key = (model_name, backend)
+        if key not in _services:
+            _services[key] = EmbeddingService(model_name, backend)
+        return _services[key]
+
+class EmbeddingService(Embeddings):
+    """
+    Lazily loaded sentence-transformers model with request batching.
+    Small requests (queries, short documents) from concurrent sessions are queued and
+    encoded together by one worker thread; large requests are already a batch and are
+    encoded directly on the caller's thread.
+    """
+
+    def __init__(self, model_name, backend="default", max_batch_size=MAX_BATCH_SIZE, batch_wait=BATCH_WAIT_SECONDS):
+        if backend not in ("default", "int8"):
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        self.model_name = model_name
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._worker = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    model = SentenceTransformer(self.model_name, device="cpu")
+                    if self.backend == "int8":
+                        import torch
+                        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                    self._model = model
+        return self._model
+
+    def encode(self, texts):
+        # Same preprocessing as HuggingFaceEmbeddings, so cached vectors stay comparable
+        texts = [text.replace("\n", " ") for text in texts]
+        return self.model.encode(texts, batch_size=self.max_batch_size, show_progress_bar=False).tolist()
+
+    def embed_documents(self, texts):
+        if len(texts) >= self.max_batch_size:
+            return self.encode(texts)
+        return self._submit(texts)
+
+    def embed_query(self, text):
+        return self._submit([text])[0]
+
+    def _submit(self, texts):
+        if not texts:
+            return []
+        if self._worker is None:
+            with self._model_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                    self._worker.start()
+        future = Future()
+        self._requests.put((texts, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            pending = [self._requests.get()]
+            size = len(pending[0][0])
+            # Collect whatever else arrives within the wait window, up to one model batch
+            while size < self.max_batch_size:
+                try:
+                    request = self._requests.get(timeout=self.batch_wait)
+                except queue.Empty:
+                    break
+                pending.append(request)
+                size += len(request[0])
+            try:
+                vectors = self.encode([text for texts, _ in pending for text in texts])
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for texts, future in pending:
+                future.set_result(vectors[offset:offset + len(texts)])
+                offset += len(texts)
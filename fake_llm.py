@@ -0,0 +1,142 @@
+"""
+Deterministic local stand-ins for the LLM: FakeChatModel for LLM_BACKEND=fake, and an
+OpenAI-compatible HTTP server for exercising llm_client against a real socket:
+
+    python fake_llm.py --port 8099 --latency 0.2 --fail-every 5
+    LLM_BASE_URL=http://127.0.0.1:8099/v1 streamlit run main.py
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List, Optional
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+
+def fake_reply(prompt, answer_words=60):
+    """The reply depends only on the prompt: its digest, the question it contains and its last words"""
+    question = re.search(r"(?:User's question|Question|Follow Up Input):\s*(.+)", prompt)
+    words = re.findall(r"\w+", prompt)[-answer_words:]
+    digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+    return f"[{digest}] {question.group(1).strip() if question else ''} {' '.join(words)}".strip()
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic local stand-in for the Groq model, used with LLM_BACKEND=fake and by benchmark.py.
+    The reply depends only on the prompt, and latency simulates the network round trip.
+    """
+
+    latency: float = 0.0
+    answer_words: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _generate(self, messages: List[Any], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        prompt = "\n".join(str(m.content) for m in messages)
+        if self.latency:
+            time.sleep(self.latency)
+        content = fake_reply(prompt, self.answer_words)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """
+    Serves POST .../chat/completions like an OpenAI-compatible API, streamed (SSE) or not,
+    with fake_reply as the answer. latency delays the first byte, token_delay each streamed
+    word, and every fail_every-th request is refused with 429 and Retry-After, to exercise
+    retries. requests counts the completions requests received.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, token_delay=0.0, fail_every=0, retry_after=0.1):
+        super().__init__(("127.0.0.1", port), FakeLLMHandler)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.fail_every = fail_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        """Serve on a daemon thread; returns self"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            return self._json(404, {"error": {"message": "not found"}})
+        with self.server.lock:
+            self.server.requests += 1
+            refuse = self.server.fail_every and self.server.requests % self.server.fail_every == 0
+        if refuse:
+            return self._json(429, {"error": {"message": "rate limited"}}, {"Retry-After": str(self.server.retry_after)})
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        reply = fake_reply(prompt)
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(reply) // 4,
+                 "total_tokens": (len(prompt) + len(reply)) // 4}
+        if not body.get("stream"):
+            return self._json(200, {"object": "chat.completion", "model": body.get("model"), "usage": usage,
+                                    "choices": [{"index": 0, "finish_reason": "stop",
+                                                 "message": {"role": "assistant", "content": reply}}]})
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = reply.split(" ")
+        for i, word in enumerate(words):
+            if self.server.token_delay:
+                time.sleep(self.server.token_delay)
+            delta = {"content": word if i == 0 else " " + word}
+            self._chunk({"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta}]})
+        self._chunk({"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                     "usage": usage})
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _chunk(self, event):
+        self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stand-in for the LLM API")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before the first byte of each reply")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Seconds between streamed words")
+    parser.add_argument("--fail-every", type=int, default=0, help="Refuse every Nth request with 429")
+    args = parser.parse_args()
+    server = FakeLLMServer(args.port, args.latency, args.token_delay, args.fail_every)
+    print(f"Serving on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,99 @@
+"""
+Append-only feedback log in SQLite (WAL mode).
+
+    python feedback_store.py streamlit_docs > feedback.jsonl
+
+streams every record as JSON lines for offline analysis.
+"""
+import json
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_feedback_store(base_dir):
+    """Return the process-wide FeedbackStore under base_dir/feedback"""
+    db_path = Path(base_dir) / "feedback" / "feedback.sqlite"
+    with _stores_lock:
+        if db_path not in _stores:
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            _stores[db_path] = FeedbackStore(db_path)
+        return _stores[db_path]
+
+class FeedbackStore:
+    """
+    Each record is one INSERT, so a click costs the same however long the log is.
+    WAL mode lets sessions in other processes append while a reader streams the log,
+    and the busy timeout makes concurrent writers wait for each other instead of failing.
+    Records from the old feedback_log.json are imported once on first use.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.lock = threading.Lock()
+        self.db = self._connect()
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS feedback (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                question TEXT, answer TEXT, feedback TEXT, timestamp TEXT)""")
+        self._import_legacy_log(self.db_path.parent / "feedback_log.json")
+
+    def _connect(self):
+        db = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _import_legacy_log(self, legacy_file):
+        # Renaming first means only one process imports the file
+        claimed = legacy_file.with_name(legacy_file.name + ".imported")
+        try:
+            legacy_file.rename(claimed)
+        except OSError:
+            return
+        with open(claimed, "r", encoding="utf-8") as f:
+            records = json.load(f)
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO feedback (question, answer, feedback, timestamp) VALUES (?, ?, ?, ?)",
+                                [(r.get("question"), r.get("answer"), r.get("feedback"), r.get("timestamp")) for r in records])
+
+    def append(self, question, answer, feedback, timestamp=None):
+        timestamp = timestamp or datetime.now().isoformat()
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO feedback (question, answer, feedback, timestamp) VALUES (?, ?, ?, ?)",
+                            (question, answer, feedback, timestamp))
+
+    def iter_records(self, since=None, batch_size=1000):
+        """
+        Yield records as dicts, oldest first, without loading the whole log.
+        since is an ISO timestamp; a separate connection is used so appends are never blocked.
+        """
+        db = self._connect()
+        try:
+            query = "SELECT id, question, answer, feedback, timestamp FROM feedback"
+            args = ()
+            if since is not None:
+                query += " WHERE timestamp >= ?"
+                args = (since,)
+            cursor = db.execute(query + " ORDER BY id", args)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for id_, question, answer, feedback, timestamp in rows:
+                    yield {"id": id_, "question": question, "answer": answer, "feedback": feedback, "timestamp": timestamp}
+        finally:
+            db.close()
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT feedback, COUNT(*) FROM feedback GROUP BY feedback").fetchall())
+
+if __name__ == "__main__":
+    base_dir = sys.argv[1] if len(sys.argv) > 1 else Path.cwd() / "streamlit_docs"
+    for record in get_feedback_store(base_dir).iter_records(since=sys.argv[2] if len(sys.argv) > 2 else None):
+        print(json.dumps(record, ensure_ascii=False))
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+import weakref
+
+INDEX_MEMORY_BUDGET_MB = float(os.environ.get("INDEX_MEMORY_BUDGET_MB", "2048"))
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_index_registry():
+    """Return the process-wide IndexRegistry"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = IndexRegistry(INDEX_MEMORY_BUDGET_MB * 1024 * 1024)
+        return _registry
+
+class IndexLease:
+    """
+    A session's reference to a shared (vector_index, bm25_index) pair.
+    The reference is dropped by release() or when the lease is garbage collected
+    together with the session state that holds it.
+    """
+
+    def __init__(self, registry, key, vector_index, bm25_index):
+        self.key = key
+        self.vector_index = vector_index
+        self.bm25_index = bm25_index
+        self._finalizer = weakref.finalize(self, registry._release, key)
+
+    def release(self):
+        self._finalizer()
+
+class IndexRegistry:
+    """
+    Loaded indexes keyed by document set, shared by every session of the process.
+    Sessions on the same files get the same in-memory indexes; each entry counts its
+    leases, and entries nobody holds are evicted least recently used first once the
+    total size exceeds the budget. Entries in use are never evicted.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.entries = {}  # key -> {"vector_index", "bm25_index", "refs", "size", "last_used"}
+        self.lock = threading.Lock()
+        self.loading = {}  # key -> [lock held while the entry is built, sessions waiting], so concurrent sessions build it once
+
+    def acquire(self, key, load):
+        """Lease the indexes for key, calling load() -> (vector_index, bm25_index) if they are not loaded yet"""
+        with self.lock:
+            loading = self.loading.setdefault(key, [threading.Lock(), 0])
+            loading[1] += 1
+        try:
+            return self._acquire(key, load, loading[0])
+        finally:
+            with self.lock:
+                loading[1] -= 1
+                # The last session through drops the lock, so keys that were loaded once do not pile up
+                if not loading[1]:
+                    del self.loading[key]
+
+    def _acquire(self, key, load, key_lock):
+        with key_lock:
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is None:
+                vector_index, bm25_index = load()
+                entry = {"vector_index": vector_index, "bm25_index": bm25_index, "refs": 0,
+                         "size": vector_index.nbytes() + bm25_index.nbytes(), "last_used": time.time()}
+            with self.lock:
+                entry = self.entries.setdefault(key, entry)
+                entry["refs"] += 1
+                entry["last_used"] = time.time()
+                self._evict()
+                return IndexLease(self, key, entry["vector_index"], entry["bm25_index"])
+
+    def _release(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry["refs"] -= 1
+            entry["last_used"] = time.time()
+            self._evict()
+
+    def _evict(self):
+        total = sum(entry["size"] for entry in self.entries.values())
+        idle = sorted((entry["last_used"], key) for key, entry in self.entries.items() if entry["refs"] <= 0)
+        for _, key in idle:
+            if total <= self.budget_bytes:
+                break
+            total -= self.entries.pop(key)["size"]
+
+    def discard(self, key):
+        """Forget an entry nobody holds, before its files are deleted; False if it is in use"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["refs"] > 0:
+                return False
+            self.entries.pop(key, None)
+            return True
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return [{"key": key, "path": entry["vector_index"].path.parent, "refs": entry["refs"],
+                     "size_mb": entry["size"] / (1024 * 1024),
+                     "idle_seconds": now - entry["last_used"] if entry["refs"] <= 0 else 0.0}
+                    for key, entry in self.entries.items()]
@@ -0,0 +1,319 @@
+import json
+import os
+import shutil
+import threading
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+from langchain.schema import Document
+from vector_store import VectorIndex
+from bm25_index import BM25Index
+from metrics import metrics
+
+INDEX_NAMES = ("vector_index", "bm25_index")
+
+_index_dirs = threading.Condition()
+_writing = set()  # document set directories being updated in this process
+_copying = {}  # document set directory -> copies of it in progress
+
+def doc_cache_path(cache_dir, file_hash):
+    """Directory holding the cached chunks and embeddings of one uploaded file"""
+    return Path(cache_dir) / "docs" / file_hash
+
+def read_cache_meta(cache_dir, file_hash, signature):
+    """Return the cache metadata for a file, or None if missing or built with other settings"""
+    try:
+        with open(doc_cache_path(cache_dir, file_hash) / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("signature") == signature else None
+
+def partial_cache_path(cache_dir, file_hash):
+    """Chunks and embeddings of a file whose ingestion was cancelled part way, resumed by the next run"""
+    return Path(cache_dir) / "docs" / f"{file_hash}.partial"
+
+class CachedDocumentWriter:
+    """
+    Appends (chunks, vectors) batches for one file to a staging directory.
+    Vectors go to a raw float32 file so batches can be written as they are embedded;
+    the directory only replaces the live cache entry once the file is complete.
+    suspend() keeps an incomplete file as a partial entry instead; with resume=True the
+    writer starts from that entry, and count tells the caller how many chunks to skip.
+    """
+
+    def __init__(self, cache_dir, file_hash, signature, resume=False):
+        self.path = doc_cache_path(cache_dir, file_hash)
+        self.partial_path = partial_cache_path(cache_dir, file_hash)
+        # Sessions of one process may ingest the same file at once, so the thread is part of the name
+        self.tmp_path = self.path.with_name(f"{file_hash}.tmp{os.getpid()}-{threading.get_ident()}")
+        self.signature = signature
+        self.count = 0
+        self.dim = 0
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        mode = "w"
+        if resume:
+            try:
+                with open(self.partial_path / "meta.json", "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta.get("signature") == signature:
+                    os.replace(self.partial_path, self.tmp_path)
+                    self.count, self.dim, mode = meta["count"], meta["dim"], "a"
+            except (OSError, ValueError):
+                pass
+        self.tmp_path.mkdir(parents=True, exist_ok=True)
+        self.chunks_file = open(self.tmp_path / "chunks.jsonl", mode, encoding="utf-8")
+        self.vectors_file = open(self.tmp_path / "vectors.f32", mode + "b")
+
+    def append(self, chunks, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(chunks) != len(vectors):
+            raise ValueError("Each chunk needs exactly one vector")
+        if not chunks:
+            return
+        for chunk in chunks:
+            self.chunks_file.write(json.dumps({"page_content": chunk.page_content, "metadata": chunk.metadata}, ensure_ascii=False) + "\n")
+        self.vectors_file.write(vectors.tobytes())
+        self.count += len(chunks)
+        self.dim = vectors.shape[1]
+
+    def close(self):
+        self.chunks_file.close()
+        self.vectors_file.close()
+        with open(self.tmp_path / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"signature": self.signature, "count": self.count, "dim": self.dim}, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+        shutil.rmtree(self.partial_path, ignore_errors=True)
+
+    def suspend(self):
+        """Keep what was written so far as the file's partial entry"""
+        self.chunks_file.close()
+        self.vectors_file.close()
+        with open(self.tmp_path / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"signature": self.signature, "count": self.count, "dim": self.dim}, f)
+        shutil.rmtree(self.partial_path, ignore_errors=True)
+        os.replace(self.tmp_path, self.partial_path)
+
+    def abort(self):
+        self.chunks_file.close()
+        self.vectors_file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def iter_cached_document(cache_dir, file_hash, signature, batch_size=1024):
+    """
+    Yield (chunks, vectors) batches for a cached file.
+    Vectors are memory-mapped, so only one batch is resident at a time.
+    """
+    meta = read_cache_meta(cache_dir, file_hash, signature)
+    if meta is None:
+        raise ValueError(f"No cached embeddings for document {file_hash}")
+    if not meta["count"]:
+        return
+    path = doc_cache_path(cache_dir, file_hash)
+    vectors = np.memmap(path / "vectors.f32", dtype=np.float32, mode="r", shape=(meta["count"], meta["dim"]))
+    chunks, start = [], 0
+    with open(path / "chunks.jsonl", "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            chunks.append(Document(page_content=record["page_content"], metadata=record["metadata"]))
+            if len(chunks) == batch_size:
+                yield chunks, np.array(vectors[start:start + len(chunks)])
+                start += len(chunks)
+                chunks = []
+    if chunks:
+        yield chunks, np.array(vectors[start:start + len(chunks)])
+
+def update_vector_index(index_path, file_hashes, cache_dir, signature):
+    """
+    Bring the memory-mapped vector index at index_path in line with file_hashes.
+    Files already in the index are left alone, removed files are tombstoned and
+    new files are appended batch by batch from their cached embeddings, so nothing is re-embedded.
+    Large indexes also get their ANN index extended or rebuilt and re-tuned here.
+    """
+    vector_index = VectorIndex.open(index_path, signature)
+    wanted = list(dict.fromkeys(file_hashes))
+    indexed = vector_index.file_hashes()
+    removed = [h for h in indexed if h not in wanted]
+    added = [h for h in wanted if h not in indexed]
+
+    for file_hash in removed:
+        vector_index.remove_file(file_hash)
+    for file_hash in added:
+        vector_index.add_file(file_hash, iter_cached_document(cache_dir, file_hash, signature))
+
+    if not len(vector_index):
+        raise ValueError("No text could be extracted from the uploaded files.")
+    ann = vector_index.meta.get("ann")
+    vector_index.update_ann()
+    if removed or added or vector_index.meta.get("ann") != ann:
+        vector_index.save()
+    return vector_index
+
+def update_bm25_index(index_path, file_hashes, cache_dir, signature):
+    """
+    Same as update_vector_index for the lexical side: the saved BM25 index is loaded,
+    removed files are tombstoned, new files are tokenized from the document cache,
+    and the result is only written back when something changed.
+    """
+    index_path = Path(index_path)
+    bm25_index = None
+    if (index_path / "signature").exists():
+        with open(index_path / "signature", "r", encoding="utf-8") as f:
+            if f.read() == signature:
+                bm25_index = BM25Index.load(index_path)
+    if bm25_index is None:
+        bm25_index = BM25Index()
+
+    indexed = bm25_index.group_names()
+    wanted = list(dict.fromkeys(file_hashes))
+    removed = [h for h in indexed if h not in wanted]
+    added = [h for h in wanted if h not in indexed]
+
+    for file_hash in removed:
+        bm25_index.remove(file_hash)
+    for file_hash in added:
+        count = 0
+        for chunks, _ in iter_cached_document(cache_dir, file_hash, signature):
+            ids = [f"{file_hash}:{i}" for i in range(count, count + len(chunks))]
+            bm25_index.add(file_hash, ids, [c.page_content for c in chunks])
+            count += len(chunks)
+
+    if removed or added:
+        bm25_index.save(index_path)
+        with open(index_path / "signature", "w", encoding="utf-8") as f:
+            f.write(signature)
+    return bm25_index
+
+def indexed_files(index_dir):
+    """File hashes in the vector index of a document set directory, or None if it has none"""
+    try:
+        with open(Path(index_dir) / "vector_index" / "meta.json", "r", encoding="utf-8") as f:
+            return list(json.load(f)["files"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+def busy_index_dirs():
+    """Document set directories being updated or copied by this process"""
+    with _index_dirs:
+        return set(_writing) | set(_copying)
+
+def copy_indexes(source_dir, target_dir):
+    """Copy the vector and BM25 indexes of source_dir to target_dir, the starting point of an incremental update"""
+    for name in INDEX_NAMES:
+        if (Path(source_dir) / name).exists():
+            shutil.copytree(Path(source_dir) / name, Path(target_dir) / name)
+
+def seed_index_dir(index_dir, file_hashes):
+    """
+    Start a missing document set directory from a copy of the set next to it whose files
+    differ least from file_hashes, so that only the added and removed files are applied.
+    Sets being updated are not copied. Returns the directory copied, or None.
+    """
+    index_dir = Path(index_dir)
+    if index_dir.exists():
+        return None
+    wanted = set(file_hashes)
+    candidates = []
+    for path in index_dir.parent.glob("*"):
+        # Skips staging directories, whose names have a suffix
+        files = indexed_files(path) if "." not in path.name else None
+        if files and wanted.intersection(files):
+            candidates.append((len(wanted.symmetric_difference(files)), str(path.resolve())))
+    with _index_dirs:
+        source = next((Path(path) for _, path in sorted(candidates) if Path(path) not in _writing), None)
+        if source is None:
+            return None
+        _copying[source] = _copying.get(source, 0) + 1
+    tmp_dir = index_dir.with_name(f"{index_dir.name}.tmp{os.getpid()}-{threading.get_ident()}")
+    try:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        copy_indexes(source, tmp_dir)
+        os.replace(tmp_dir, index_dir)
+        return source
+    except OSError:
+        # E.g. evicted while being copied; the set is then built from the document cache
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return None
+    finally:
+        with _index_dirs:
+            _copying[source] -= 1
+            if not _copying[source]:
+                del _copying[source]
+            _index_dirs.notify_all()
+
+def update_document_set(index_dir, file_hashes, cache_dir, signature):
+    """
+    Bring the vector and BM25 indexes of a document set directory in line with file_hashes
+    and return (vector_index, bm25_index). A new set starts from the closest existing one
+    (seed_index_dir). Updates of a directory wait for other updates and copies of it.
+    """
+    index_dir = Path(index_dir).resolve()
+    with _index_dirs:
+        _index_dirs.wait_for(lambda: index_dir not in _writing and index_dir not in _copying)
+        _writing.add(index_dir)
+    try:
+        with metrics.span("index.seed"):
+            seed_index_dir(index_dir, file_hashes)
+        with metrics.span("index.vector"):
+            vector_index = update_vector_index(index_dir / "vector_index", file_hashes, cache_dir, signature)
+        with metrics.span("index.bm25"):
+            bm25_index = update_bm25_index(index_dir / "bm25_index", file_hashes, cache_dir, signature)
+        return vector_index, bm25_index
+    finally:
+        with _index_dirs:
+            _writing.discard(index_dir)
+            _index_dirs.notify_all()
+
+def build_index_artifacts(artifacts_dir, files, signature):
+    """
+    Write a new version of the vector and BM25 indexes for files, a list of (file_name, file_hash, chunk_count).
+    The chunk store is the document cache under artifacts_dir/docs, shared by all versions.
+    Each version starts from a copy of the latest one, so only changed files are indexed,
+    and LATEST is switched over only after the version is complete.
+    """
+    artifacts_dir = Path(artifacts_dir)
+    version = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    version_dir = artifacts_dir / "versions" / version
+    try:
+        previous_dir, _ = resolve_index_artifacts(artifacts_dir)
+    except (OSError, ValueError):
+        previous_dir = None
+    if previous_dir is not None and previous_dir != version_dir:
+        copy_indexes(previous_dir, version_dir)
+
+    file_hashes = [file_hash for _, file_hash, _ in files]
+    vector_index = update_vector_index(version_dir / "vector_index", file_hashes, artifacts_dir, signature)
+    bm25_index = update_bm25_index(version_dir / "bm25_index", file_hashes, artifacts_dir, signature)
+    manifest = {
+        "version": version,
+        "created": datetime.now().isoformat(),
+        "signature": signature,
+        "chunks": len(bm25_index),
+        "vector_index": vector_index.meta.get("ann") or {"type": "flat"},
+        "files": [{"name": name, "hash": file_hash, "chunks": count} for name, file_hash, count in files]
+    }
+    with open(version_dir / "manifest.json", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    latest_tmp = artifacts_dir / f"LATEST.tmp{os.getpid()}"
+    latest_tmp.write_text(version, encoding="utf-8")
+    os.replace(latest_tmp, artifacts_dir / "LATEST")
+    return version_dir, manifest
+
+def resolve_index_artifacts(artifacts_dir, version=None):
+    """Return (version_dir, manifest) for a version of the artifacts, the latest one by default"""
+    artifacts_dir = Path(artifacts_dir)
+    if version is None:
+        version = (artifacts_dir / "LATEST").read_text(encoding="utf-8").strip()
+    version_dir = artifacts_dir / "versions" / version
+    with open(version_dir / "manifest.json", "r", encoding="utf-8") as f:
+        return version_dir, json.load(f)
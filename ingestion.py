@@ -0,0 +1,525 @@
+import os
+import threading
+import time
+import hashlib
+import re
+from collections import Counter
+from itertools import islice
+import numpy as np
+import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from langchain_community.document_loaders import PyPDFLoader, TextLoader, CSVLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema import Document
+from utils import clean_text
+from indexing import CachedDocumentWriter, doc_cache_path, read_cache_meta
+from embedding_service import EMBEDDING_MODEL, EMBEDDING_BACKEND
+from metrics import metrics
+from storage_manager import mark_used
+from ocr import IMAGE_EXTENSIONS, image_documents, ocr_cache_path, with_ocr
+
+CHUNK_SIZE = 1500
+CHUNK_OVERLAP = 100
+
+# Worker count for parsing/splitting and for embedding batches; 0 means one per core
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "0")) or os.cpu_count() or 1
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+# Files at least this large are streamed page by page instead of loaded whole
+STREAM_THRESHOLD_BYTES = int(float(os.environ.get("STREAM_THRESHOLD_MB", "20")) * 1024 * 1024)
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+TEXT_BLOCK_CHARS = 64 * 1024
+# "blocks" groups CSV rows into chunk-sized blocks under a header line; "rows" is CSVLoader's Document per row
+CSV_INGEST_MODE = os.environ.get("CSV_INGEST_MODE", "blocks")
+CSV_READ_ROWS = int(os.environ.get("CSV_READ_ROWS", "10000"))
+# Also index a summary of each column (type, range, frequent values)
+CSV_COLUMN_STATS = os.environ.get("CSV_COLUMN_STATS", "1") == "1"
+CSV_TOP_VALUES = 5
+# Distinct values counted per text column; beyond that the frequent values are approximate
+CSV_MAX_TRACKED_VALUES = 1000
+CONTROL_CHARS = re.compile(r'[\u0000-\u001F\u007F-\u009F\uD800-\uDFFF]')
+# Joins the rows of a block while they are cleaned; a private-use character, so not found in data
+ROW_SEPARATOR = "\uE000"
+# Cached embeddings are only reused when they were produced with the same settings;
+# csv2 keeps rows with more fields than the header, which the first CSV reader dropped
+CACHE_SIGNATURE = (f"{EMBEDDING_MODEL}:{EMBEDDING_BACKEND}:{CHUNK_SIZE}:{CHUNK_OVERLAP}"
+                   f":csv2-{CSV_INGEST_MODE}{'-stats' if CSV_COLUMN_STATS else ''}")
+
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".csv") + IMAGE_EXTENSIONS
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+class IngestCancelled(Exception):
+    """Raised by ingest_files when its cancel event is set; embeddings computed so far are kept"""
+
+def get_loader(filepath, file_name):
+    if file_name.endswith(".pdf"):
+        return PyPDFLoader(filepath)
+    elif file_name.endswith(".txt"):
+        return TextLoader(filepath)
+    elif file_name.endswith(".csv"):
+        return CSVLoader(filepath)
+    return None
+
+def save_upload(file, uploads_dir, file_name):
+    """
+    Save an uploaded file as uploads_dir/<md5>/<file_name> and return (md5, filepath).
+    The upload is hashed while it is written to a temporary name in one pass, then renamed into
+    place; the path is named after the content, so background jobs reading it never see it change,
+    and when a copy already exists the temporary file is dropped instead.
+    """
+    os.makedirs(uploads_dir, exist_ok=True)
+    tmp_path = os.path.join(uploads_dir, f".upload.tmp{os.getpid()}-{threading.get_ident()}")
+    md5 = hashlib.md5()
+    file.seek(0)
+    try:
+        with open(tmp_path, "wb") as f:
+            while block := file.read(UPLOAD_BLOCK_SIZE):
+                md5.update(block)
+                f.write(block)
+        file_hash = md5.hexdigest()
+        target_dir = os.path.join(uploads_dir, file_hash)
+        filepath = os.path.join(target_dir, os.path.basename(file_name))
+        if os.path.exists(filepath):
+            os.remove(tmp_path)
+            mark_used(target_dir)
+        else:
+            os.makedirs(target_dir, exist_ok=True)
+            os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    file.seek(0)
+    return file_hash, filepath
+
+def hash_file(filepath):
+    """MD5 of a file on disk, read in fixed-size blocks; matches the hash save_upload computes"""
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        while block := f.read(UPLOAD_BLOCK_SIZE):
+            md5.update(block)
+    return md5.hexdigest()
+
+def iter_text_documents(filepath, block_chars=TEXT_BLOCK_CHARS):
+    """Yield a plain-text file as Documents of roughly block_chars, split on line boundaries"""
+    lines, size = [], 0
+    with open(filepath, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            lines.append(line)
+            size += len(line)
+            if size >= block_chars:
+                yield Document(page_content="".join(lines), metadata={"source": filepath})
+                lines, size = [], 0
+    if lines:
+        yield Document(page_content="".join(lines), metadata={"source": filepath})
+
+def csv_blocks_enabled(file_name):
+    return file_name.endswith(".csv") and CSV_INGEST_MODE == "blocks"
+
+def iter_csv_documents(filepath, file_name, block_chars=CHUNK_SIZE, column_stats=None):
+    """
+    Yield a CSV as Documents of whole rows, each block about block_chars long and starting with
+    the column names, reading CSV_READ_ROWS rows at a time so memory does not grow with the file.
+    Rows are rendered a column at a time with pandas and cleaned in one pass. With column_stats (default
+    CSV_COLUMN_STATS) a final Document summarizes every column.
+    """
+    column_stats = CSV_COLUMN_STATS if column_stats is None else column_stats
+    stats, header, row = None, None, 0
+    for frame in read_csv_frames(filepath):
+        if header is None:
+            columns = unique_columns([CONTROL_CHARS.sub(" ", str(c)).strip() for c in frame.columns])
+            header = " | ".join(columns) + "\n"
+            stats = {c: {"filled": 0, "numeric": 0, "min": np.inf, "max": -np.inf, "sum": 0.0, "values": Counter()}
+                     for c in columns}
+        if frame.empty:
+            continue
+        # Short rows leave NaN in the missing fields
+        frame = frame.fillna("")
+        frame.columns = list(stats)
+        if column_stats:
+            update_column_stats(stats, frame)
+        lines = frame.iloc[:, 0].str.cat([frame[c] for c in frame.columns[1:]], sep=" | ").tolist()
+        # One regex pass over the whole read instead of one per cell; line breaks inside cells become spaces
+        lines = CONTROL_CHARS.sub(" ", ROW_SEPARATOR.join(lines)).split(ROW_SEPARATOR)
+        # Row boundaries of each block from the cumulative text length
+        ends = np.cumsum([len(line) + 1 for line in lines])
+        budget = max(block_chars - len(header), 1)
+        start = 0
+        while start < len(lines):
+            offset = ends[start - 1] if start else 0
+            stop = max(int(np.searchsorted(ends, offset + budget, side="right")), start + 1)
+            yield Document(page_content=header + "\n".join(lines[start:stop]),
+                           metadata={"source": file_name, "row_start": row + start, "row_end": row + stop - 1})
+            start = stop
+        row += len(lines)
+    if column_stats and row:
+        yield Document(page_content=column_summary(file_name, stats, row),
+                       metadata={"source": file_name, "column_stats": True})
+
+def read_csv_frames(filepath):
+    """
+    DataFrames of up to CSV_READ_ROWS rows of a CSV, every field a string. A row with more fields
+    than the header keeps them, joined into its last column, so row numbers match the file.
+    """
+    try:
+        width = len(pd.read_csv(filepath, nrows=0, encoding_errors="replace").columns)
+    except pd.errors.EmptyDataError:
+        return
+    # Only the python parser can keep long rows; the C one drops them, or truncates them without a word
+    yield from pd.read_csv(filepath, engine="python", chunksize=CSV_READ_ROWS, dtype=str, keep_default_na=False,
+                           on_bad_lines=lambda fields: fields[:width - 1] + [",".join(fields[width - 1:])],
+                           encoding_errors="replace", skipinitialspace=True)
+
+def unique_columns(columns):
+    """Column names made distinct with a .1, .2 ... suffix, like pandas does for duplicates it sees"""
+    names = []
+    for column in columns:
+        name, n = column, 0
+        while name in names:
+            n += 1
+            name = f"{column}.{n}"
+        names.append(name)
+    return names
+
+def update_column_stats(stats, frame):
+    """Fold one block of rows into the running per-column statistics"""
+    for column in frame.columns:
+        values = frame[column]
+        filled = values[values.str.strip() != ""]
+        numbers = pd.to_numeric(filled, errors="coerce").dropna()
+        entry = stats[column]
+        entry["filled"] += len(filled)
+        entry["numeric"] += len(numbers)
+        if len(numbers):
+            entry["min"] = min(entry["min"], float(numbers.min()))
+            entry["max"] = max(entry["max"], float(numbers.max()))
+            entry["sum"] += float(numbers.sum())
+        if len(numbers) < len(filled):
+            entry["values"].update(filled.value_counts().to_dict())
+            if len(entry["values"]) > CSV_MAX_TRACKED_VALUES:
+                entry["values"] = Counter(dict(entry["values"].most_common(CSV_MAX_TRACKED_VALUES // 2)))
+
+def column_summary(file_name, stats, rows):
+    lines = [f"Column summary of {file_name} ({rows} rows)"]
+    for column, entry in stats.items():
+        # A few stray labels or typos do not make a numeric column text
+        if entry["numeric"] and entry["numeric"] >= 0.95 * entry["filled"]:
+            others = ", ".join(f"{value} ({count})" for value, count in entry["values"].most_common(CSV_TOP_VALUES))
+            lines.append(f"{column}: numeric, {entry['numeric']} values, min {entry['min']:g}, max {entry['max']:g}, "
+                         f"mean {entry['sum'] / entry['numeric']:g}{f', other values: {others}' if others else ''}")
+        else:
+            top = ", ".join(f"{value} ({count})" for value, count in entry["values"].most_common(CSV_TOP_VALUES))
+            lines.append(f"{column}: text, {entry['filled']} values, {len(entry['values'])}"
+                         f"{'+' if len(entry['values']) >= CSV_MAX_TRACKED_VALUES // 2 else ''} distinct"
+                         f"{f', most frequent: {top}' if top else ''}")
+    # Values were counted before the rows were cleaned
+    return "\n".join(CONTROL_CHARS.sub(" ", line) for line in lines)
+
+def iter_file_chunks(filepath, file_name, chunk_size, chunk_overlap, ocr_cache=None):
+    """
+    Generator version of load_file_chunks: pages (PDF), rows (CSV) or text blocks (TXT)
+    are cleaned and split one at a time, so memory does not grow with the file size.
+    Scanned pages are OCR'd in batches as they come.
+    """
+    if csv_blocks_enabled(file_name):
+        # Blocks are cleaned and sized already; only a summary longer than a chunk gets split
+        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        for doc in iter_csv_documents(filepath, file_name, chunk_size):
+            yield from splitter.split_documents([doc])
+        return
+    if file_name.endswith(".txt"):
+        docs = iter_text_documents(filepath)
+    elif file_name.endswith(IMAGE_EXTENSIONS):
+        docs = image_documents(file_name)
+    else:
+        loader = get_loader(filepath, file_name)
+        if loader is None:
+            return
+        docs = loader.lazy_load()
+    if file_name.endswith((".pdf",) + IMAGE_EXTENSIONS):
+        docs = with_ocr(iter_cleaned(docs), filepath, file_name, ocr_cache)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    for doc in docs:
+        doc.page_content = clean_text(doc.page_content)
+        doc.metadata['source'] = file_name
+        yield from splitter.split_documents([doc])
+
+def iter_cleaned(docs):
+    for doc in docs:
+        doc.page_content = clean_text(doc.page_content)
+        yield doc
+
+def iter_batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def load_file_chunks(filepath, file_name, chunk_size, chunk_overlap, timings=None, ocr_cache=None):
+    """
+    Load, clean and split one file. Runs in a worker process, so it only takes picklable arguments.
+    Images and PDF pages without a text layer are OCR'd (see ocr.with_ocr), using ocr_cache if given.
+    If timings is a dict, the load, OCR and split durations are stored in it.
+    """
+    start = time.perf_counter()
+    if csv_blocks_enabled(file_name):
+        docs = list(iter_csv_documents(filepath, file_name, chunk_size))
+    elif file_name.endswith(IMAGE_EXTENSIONS):
+        docs = image_documents(file_name)
+    else:
+        loader = get_loader(filepath, file_name)
+        if loader is None:
+            return None
+        docs = loader.load()
+    if not csv_blocks_enabled(file_name):
+        for doc in docs:
+            doc.page_content = clean_text(doc.page_content)
+            doc.metadata['source'] = file_name  # Ensure source is in metadata
+    if file_name.endswith((".pdf",) + IMAGE_EXTENSIONS):
+        docs = list(with_ocr(docs, filepath, file_name, ocr_cache, timings))
+        for doc in docs:
+            if doc.metadata.get("ocr"):
+                doc.page_content = clean_text(doc.page_content)
+    loaded = time.perf_counter()
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunks = splitter.split_documents(docs)
+    if timings is not None:
+        timings["ingest.load"] = loaded - start - timings.get("ingest.ocr", 0.0)
+        timings["ingest.split"] = time.perf_counter() - loaded
+    return chunks
+
+def load_file_chunks_timed(filepath, file_name, chunk_size, chunk_overlap, ocr_cache=None):
+    """
+    load_file_chunks returning (chunks, timings, error), so worker-side durations reach the parent's
+    metrics. A file that cannot be read or OCR'd gives no chunks and the error message instead.
+    """
+    timings = {}
+    try:
+        return load_file_chunks(filepath, file_name, chunk_size, chunk_overlap, timings, ocr_cache), timings, None
+    except Exception as e:
+        return None, timings, f"{type(e).__name__}: {e}"
+
+def get_parse_pool():
+    """Process-wide pool of INGEST_WORKERS parsing processes, kept between ingests so each loads the OCR model once"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+        return _parse_pool
+
+def _replace_parse_pool(pool):
+    """Drop a pool whose worker died; the next get_parse_pool() starts a new one"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+    return get_parse_pool()
+
+def load_files_parallel(files, chunk_size, chunk_overlap, workers=None):
+    """
+    Run load_file_chunks over (filepath, file_name, ocr_cache) entries on the shared parse pool,
+    at most workers files at a time, and yield (chunks, error) per file in input order, so chunk
+    order matches a serial run. A file that fails has chunks None and does not stop the others.
+    """
+    workers = min(workers or INGEST_WORKERS, len(files))
+    if workers <= 1:
+        for path, name, ocr_cache in files:
+            chunks, timings, error = load_file_chunks_timed(path, name, chunk_size, chunk_overlap, ocr_cache)
+            for stage, seconds in timings.items():
+                metrics.observe(stage, seconds)
+            yield chunks, error
+        return
+    pool = get_parse_pool()
+    entries, pending = iter(files), deque()  # (entry, future) in input order
+    try:
+        while True:
+            while len(pending) < workers and (entry := next(entries, None)) is not None:
+                pending.append((entry, pool.submit(load_file_chunks_timed, entry[0], entry[1], chunk_size, chunk_overlap, entry[2])))
+            if not pending:
+                return
+            entry, future = pending.popleft()
+            try:
+                chunks, timings, error = future.result()
+            except BrokenProcessPool as e:
+                # A worker died (e.g. out of memory) on this file; the files after it go to a new pool
+                chunks, timings, error = None, {}, f"{type(e).__name__}: {e}"
+                pool = _replace_parse_pool(pool)
+                pending = deque((entry, pool.submit(load_file_chunks_timed, entry[0], entry[1], chunk_size, chunk_overlap, entry[2]))
+                                for entry, _ in pending)
+            for stage, seconds in timings.items():
+                metrics.observe(stage, seconds)
+            yield chunks, error
+    finally:
+        # Only matters when the caller stops early: files not started yet are dropped
+        for _, future in pending:
+            future.cancel()
+
+def embed_texts(embeddings, texts, batch_size=None, workers=None, cancel=None):
+    """
+    Embed texts in fixed-size batches spread over a thread pool, keeping input order.
+    When the cancel event is set, batches not started yet are skipped and only the
+    vectors of the leading finished batches are returned (fewer than len(texts)).
+    """
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    if not batches:
+        return []
+    workers = min(workers or INGEST_WORKERS, len(batches))
+    results = []
+    with metrics.span("ingest.embed"):
+        if workers <= 1:
+            for batch in batches:
+                if cancel is not None and cancel.is_set():
+                    break
+                results.append(embeddings.embed_documents(batch))
+        else:
+            # The model releases the GIL inside its forward pass, so threads share one copy of it
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(embeddings.embed_documents, batch) for batch in batches]
+                remaining = set(futures)
+                while remaining:
+                    _, remaining = wait(remaining, timeout=0.2, return_when=FIRST_COMPLETED)
+                    if cancel is not None and cancel.is_set():
+                        for future in remaining:
+                            future.cancel()
+                        break
+                for future in futures:
+                    if future.cancelled():
+                        break
+                    results.append(future.result())
+    vectors = [vector for batch in results for vector in batch]
+    metrics.increment("ingest_chunks_embedded_total", len(vectors))
+    return vectors
+
+def embed_and_cache(loaded_files, embeddings, cache_dir, workers=None, progress=None, cancel=None):
+    """
+    Embed the chunks of several (file_name, file_hash, chunks) entries together and cache each file.
+    Chunks kept from a cancelled earlier run are not embedded again. If cancel is set part way,
+    the files embedded so far are cached, the rest keep partial entries and IngestCancelled is raised.
+    """
+    writers = [CachedDocumentWriter(cache_dir, file_hash, CACHE_SIGNATURE, resume=True) for _, file_hash, _ in loaded_files]
+    texts = [chunk.page_content for (_, _, chunks), writer in zip(loaded_files, writers) for chunk in chunks[writer.count:]]
+    try:
+        vectors = embed_texts(embeddings, texts, workers=workers, cancel=cancel)
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    offset = 0
+    with metrics.span("ingest.cache_write"):
+        for (_, file_hash, chunks), writer in zip(loaded_files, writers):
+            done = min(len(chunks) - writer.count, len(vectors) - offset)
+            writer.append(chunks[writer.count:writer.count + done], vectors[offset:offset + done])
+            offset += done
+            if writer.count == len(chunks):
+                writer.close()
+                if progress is not None:
+                    progress(file_hash, "done", writer.count, len(chunks))
+            else:
+                writer.suspend()
+                if progress is not None:
+                    progress(file_hash, "cancelled", writer.count, len(chunks))
+    if len(vectors) < len(texts):
+        raise IngestCancelled()
+
+def ingest_files(files, cache_dir, embeddings, workers=None, progress=None, cancel=None):
+    """
+    Make sure every (file_name, file_hash, filepath) entry has chunks and embeddings in the document cache.
+    Files already cached are skipped, small files are parsed in a process pool and embedded in
+    batches that span files, and large files are streamed. Returns {file_hash: {"file_name", "chunk_count"}}.
+    progress(file_hash, status, chunks_done, chunks_total, error) is called as files move through
+    "parsing", "embedding" and "done", or "failed" with the error message for a file that cannot
+    be read, which is left out while the others go on. Setting the cancel event (a threading.Event) stops the
+    run at the next batch with IngestCancelled; finished files stay cached and embeddings of
+    unfinished ones are kept as partial entries that the next run resumes from.
+    """
+    def report(file_hash, status, done=0, total=None, error=None):
+        if progress is not None:
+            progress(file_hash, status, done, total, error)
+
+    def check_cancel():
+        if cancel is not None and cancel.is_set():
+            raise IngestCancelled()
+
+    processed, small_files, large_files = {}, [], []
+    # The same file uploaded under two names is ingested once
+    files = list({file_hash: (file_name, file_hash, filepath) for file_name, file_hash, filepath in files}.values())
+    for file_name, file_hash, filepath in files:
+        meta = read_cache_meta(cache_dir, file_hash, CACHE_SIGNATURE)
+        if meta is not None:
+            mark_used(doc_cache_path(cache_dir, file_hash))
+            processed[file_hash] = {"file_name": file_name, "chunk_count": meta["count"]}
+            metrics.increment("ingest_files_total", source="cache")
+            report(file_hash, "done", meta["count"], meta["count"])
+        elif os.path.getsize(filepath) >= STREAM_THRESHOLD_BYTES:
+            large_files.append((file_name, file_hash, filepath))
+        else:
+            small_files.append((file_name, file_hash, filepath))
+
+    for _, file_hash, _ in small_files:
+        report(file_hash, "parsing")
+    loaded = load_files_parallel([(filepath, file_name, str(ocr_cache_path(cache_dir, file_hash)))
+                                  for file_name, file_hash, filepath in small_files],
+                                 CHUNK_SIZE, CHUNK_OVERLAP, workers)
+    pending, pending_chunks = [], 0
+    try:
+        for (file_name, file_hash, _), (chunks, error) in zip(small_files, loaded):
+            if error is not None:
+                metrics.increment("ingest_files_total", source="failed")
+                report(file_hash, "failed", error=error)
+                continue
+            metrics.increment("ingest_files_total", source="parsed")
+            metrics.increment("ingest_chunks_total", len(chunks))
+            report(file_hash, "embedding", 0, len(chunks))
+            pending.append((file_name, file_hash, chunks))
+            pending_chunks += len(chunks)
+            processed[file_hash] = {"file_name": file_name, "chunk_count": len(chunks)}
+            if cancel is not None and cancel.is_set():
+                break
+            if pending_chunks >= EMBED_BATCH_SIZE * (workers or INGEST_WORKERS):
+                embed_and_cache(pending, embeddings, cache_dir, workers, progress, cancel)
+                pending, pending_chunks = [], 0
+    finally:
+        loaded.close()
+    embed_and_cache(pending, embeddings, cache_dir, workers, progress, cancel)
+    check_cancel()
+
+    # Large files are streamed: peak memory is one embedding batch whatever the document size
+    for file_name, file_hash, filepath in large_files:
+        report(file_hash, "parsing")
+        writer = CachedDocumentWriter(cache_dir, file_hash, CACHE_SIGNATURE, resume=True)
+        resumed = writer.count
+        try:
+            with metrics.span("ingest.stream_file"):
+                chunks = iter_file_chunks(filepath, file_name, CHUNK_SIZE, CHUNK_OVERLAP, ocr_cache_path(cache_dir, file_hash))
+                # Chunks from a cancelled run are already in the writer; splitting is deterministic
+                for batch in iter_batches(islice(chunks, resumed, None), EMBED_BATCH_SIZE):
+                    check_cancel()
+                    with metrics.span("ingest.embed"):
+                        vectors = embeddings.embed_documents([chunk.page_content for chunk in batch])
+                    writer.append(batch, vectors)
+                    metrics.increment("ingest_chunks_embedded_total", len(batch))
+                    report(file_hash, "embedding", writer.count)
+        except IngestCancelled:
+            writer.suspend()
+            report(file_hash, "cancelled", writer.count)
+            raise
+        except Exception as e:
+            writer.abort()
+            metrics.increment("ingest_files_total", source="failed")
+            report(file_hash, "failed", error=f"{type(e).__name__}: {e}")
+            continue
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        processed[file_hash] = {"file_name": file_name, "chunk_count": writer.count}
+        report(file_hash, "done", writer.count, writer.count)
+        metrics.increment("ingest_files_total", source="streamed")
+        metrics.increment("ingest_chunks_total", writer.count)
+    return processed
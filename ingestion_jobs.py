@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from ingestion import CACHE_SIGNATURE, IngestCancelled, ingest_files
+from indexing import update_document_set
+from embedding_service import get_embedding_service
+from answer_cache import document_set_key
+from index_registry import get_index_registry
+from metrics import metrics
+from storage_manager import get_storage_manager, mark_used
+
+# Ingestion jobs running at once; each one also uses INGEST_WORKERS processes/threads internally
+INGEST_JOB_WORKERS = int(os.environ.get("INGEST_JOB_WORKERS", "2"))
+# Minimum time between two index snapshots of the files a running job has finished
+INGEST_PUBLISH_SECONDS = float(os.environ.get("INGEST_PUBLISH_SECONDS", "5"))
+
+# Index snapshots are built here, so embedding goes on while a snapshot is indexed
+_publish_pool = ThreadPoolExecutor(max_workers=INGEST_JOB_WORKERS, thread_name_prefix="ingest-publish")
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_ingestion_queue():
+    """Return the process-wide IngestionQueue"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = IngestionQueue(INGEST_JOB_WORKERS)
+        return _queue
+
+class IngestionJob:
+    """
+    Background ingestion of one set of saved uploads, (file_name, file_hash, filepath) entries.
+    progress holds per-file status ("queued", "parsing", "embedding", "done", "cancelled",
+    "failed") and chunk counts. Whenever files finish, at most every INGEST_PUBLISH_SECONDS,
+    the job adds them to its index directory, named after the document set of all its files,
+    and leases the result so sessions can chat with them while the rest is ingested;
+    ready() describes the latest such snapshot. Snapshots are indexed on a separate thread
+    and each one replaces the previous one in the index registry.
+    """
+
+    def __init__(self, files, dirs, workers=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.files = files
+        self.dirs = dirs
+        self.cache_dir = dirs["cache_dir"]
+        self.index_dir = Path(self.cache_dir) / "indexes" / document_set_key([file_hash for _, file_hash, _ in files])
+        self.workers = workers
+        self.status = "queued"  # running, done, cancelled or failed once it ends
+        self.error = None
+        self.progress = {file_hash: {"file_name": file_name, "status": "queued", "chunks_done": 0, "chunks_total": None,
+                                     "error": None}
+                         for file_name, file_hash, _ in files}
+        self.subscribers = 1
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+        self.lease = None
+        self._ready = None
+        self._published_at = 0.0
+        self._publishing = None  # Future of the snapshot being indexed
+
+    def cancel(self):
+        """Drop one subscriber; the job stops at its next batch when no session wants it any more"""
+        with self.lock:
+            self.subscribers -= 1
+            if self.subscribers <= 0:
+                self.cancel_event.set()
+
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def ready(self):
+        """{"version", "files": [(file_name, file_hash, chunk_count)]} for the latest finished files with built indexes, or None"""
+        with self.lock:
+            return self._ready
+
+    def snapshot(self):
+        with self.lock:
+            return {"status": self.status, "error": self.error,
+                    "files": [dict(self.progress[file_hash]) for _, file_hash, _ in self.files]}
+
+    def _update(self, file_hash, status, done=0, total=None, error=None):
+        with self.lock:
+            entry = self.progress[file_hash]
+            entry["status"] = status
+            entry["chunks_done"] = done
+            if total is not None:
+                entry["chunks_total"] = total
+            if error is not None:
+                entry["error"] = error
+        with self.lock:
+            due = (status == "done" and time.monotonic() - self._published_at >= INGEST_PUBLISH_SECONDS
+                   and (self._publishing is None or self._publishing.done()))
+            if due:
+                self._published_at = time.monotonic()
+                self._publishing = _publish_pool.submit(self._publish)
+
+    def _publish(self):
+        with self.lock:
+            finished = [(file_name, file_hash, self.progress[file_hash]["chunks_done"]) for file_name, file_hash, _ in self.files
+                        if self.progress[file_hash]["status"] == "done"]
+            if not finished or (self._ready is not None and len(self._ready["files"]) == len(finished)):
+                return
+        file_hashes = [file_hash for _, file_hash, _ in finished]
+        try:
+            with metrics.span("ingest.publish"):
+                lease = get_index_registry().acquire(
+                    document_set_key(file_hashes),
+                    lambda: update_document_set(self.index_dir, file_hashes, self.cache_dir, CACHE_SIGNATURE))
+        except ValueError:
+            # Nothing indexable among the finished files yet (e.g. only empty files)
+            return
+        # A set another session already loaded is served from that session's directory
+        index_dir = lease.vector_index.path.parent
+        mark_used(index_dir)
+        with open(index_dir / "files.json", "w", encoding="utf-8") as f:
+            json.dump({file_hash: file_name for file_name, file_hash, _ in finished}, f, ensure_ascii=False)
+        with self.lock:
+            previous, self.lease = self.lease, lease
+            self._ready = {"version": (self._ready or {"version": 0})["version"] + 1, "files": finished}
+        if previous is not None:
+            previous.release()
+            # The superseded snapshot goes now, or once the last session on it has moved on
+            if previous.key != lease.key:
+                get_index_registry().discard(previous.key)
+
+    def _finish_publishing(self):
+        """Wait for the snapshot being indexed, then index whatever finished after it"""
+        with self.lock:
+            publishing = self._publishing
+        if publishing is not None:
+            publishing.result()
+        self._publish()
+
+    def run(self):
+        with self.lock:
+            if self.cancel_event.is_set():
+                self.status = "cancelled"
+                return
+            self.status = "running"
+        try:
+            with metrics.span("ingest.files"):
+                ingest_files(self.files, self.cache_dir, get_embedding_service(), self.workers,
+                             progress=self._update, cancel=self.cancel_event)
+            self._finish_publishing()
+            status = "done"
+        except IngestCancelled:
+            status = "cancelled"
+        except Exception as e:
+            status = "failed"
+            self.error = str(e)
+        with self.lock:
+            self.status = status
+            for entry in self.progress.values():
+                # Files that failed on their own keep their error; the job went on without them
+                if entry["status"] not in ("done", "failed"):
+                    entry["status"] = "failed" if status == "failed" else "cancelled"
+        metrics.increment("ingest_jobs_total", status=status)
+        try:
+            # New caches and indexes may have pushed the directories over budget
+            get_storage_manager(self.dirs).enforce()
+        except OSError:
+            pass
+
+class IngestionQueue:
+    """
+    Runs IngestionJobs on a small thread pool, off the Streamlit script thread.
+    A session uploading the same files as a job that is still running joins that job
+    instead of starting another one.
+    """
+
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-job")
+        self.jobs = {}  # file hashes -> active job
+        self.lock = threading.Lock()
+
+    def submit(self, files, dirs, workers=None):
+        key = (str(dirs["cache_dir"]), tuple(file_hash for _, file_hash, _ in files))
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is not None and job.active():
+                with job.lock:
+                    if not job.cancel_event.is_set():
+                        job.subscribers += 1
+                        return job
+            job = self.jobs[key] = IngestionJob(files, dirs, workers)
+            self.pool.submit(self._run, key, job)
+            return job
+
+    def active_files(self):
+        """(file_name, file_hash, filepath) of every job still queued or running"""
+        with self.lock:
+            return [entry for job in self.jobs.values() if job.active() for entry in job.files]
+
+    def active_index_dirs(self):
+        """Index directories written by jobs still queued or running"""
+        with self.lock:
+            return [job.index_dir for job in self.jobs.values() if job.active()]
+
+    def _run(self, key, job):
+        try:
+            job.run()
+        finally:
+            with self.lock:
+                if self.jobs.get(key) is job:
+                    del self.jobs[key]
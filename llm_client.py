@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, List, Optional
+import httpx
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from metrics import metrics
+
+# Any OpenAI-compatible chat completions API; point it at fake_llm.py's server for offline tests
+LLM_BASE_URL = os.environ.get("LLM_BASE_URL", "https://api.groq.com/openai/v1")
+LLM_MODEL = os.environ.get("LLM_MODEL", "Llama3-8b-8192")
+# Client-side limit shared by all sessions of the process; bursts of up to a minute's worth are allowed
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_REQUESTS_PER_MINUTE", "30"))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "60"))
+LLM_BACKOFF_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 20.0
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# Tag of the LLM call that writes the answer, the one whose tokens are streamed into the chat
+ANSWER_TAG = "final_answer"
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_llm_client(api_key, base_url=None):
+    """Return the process-wide LLMClient for an API endpoint and key"""
+    key = (base_url or LLM_BASE_URL, api_key)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = LLMClient(*key)
+        return _clients[key]
+
+class LLMRequestError(Exception):
+    """The API rejected a request, or kept failing after LLM_MAX_RETRIES retries"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class RateLimiter:
+    """Token bucket: rate requests per minute on average, with bursts of up to burst requests"""
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.burst = burst or max(per_minute, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                if wait <= 0:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """The server asked to slow down: hold every caller back, not just the one that was refused"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class Flight:
+    """
+    One request in progress and the text pieces it has produced so far.
+    Every caller that asked for the same request iterates the same Flight, each from the
+    start, so late joiners replay what was already received and then follow live.
+    """
+
+    def __init__(self):
+        self.pieces = []
+        self.usage = {}
+        self.error = None
+        self.done = False
+        self.condition = threading.Condition()
+
+    def add(self, piece):
+        with self.condition:
+            self.pieces.append(piece)
+            self.condition.notify_all()
+
+    def finish(self, error=None, usage=None):
+        with self.condition:
+            self.error = error
+            self.usage = usage or {}
+            self.done = True
+            self.condition.notify_all()
+
+    def __iter__(self) -> Iterator[str]:
+        position = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.done or len(self.pieces) > position)
+                pieces, done, error = self.pieces[position:], self.done, self.error
+            position += len(pieces)
+            yield from pieces
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+    def text(self):
+        return "".join(self)
+
+class LLMClient:
+    """
+    Chat completions over one pooled HTTP client, shared by every session of the process.
+    Requests run on a pool of LLM_MAX_CONCURRENCY threads behind a RateLimiter, and are
+    retried with exponential backoff and jitter on connection errors, 429 (honouring
+    Retry-After) and 5xx. Identical requests in flight at the same time are sent once and
+    every caller reads the same Flight.
+    """
+
+    def __init__(self, base_url, api_key):
+        self.http = httpx.Client(base_url=base_url.rstrip("/") + "/", timeout=LLM_TIMEOUT_SECONDS,
+                                 headers={"Authorization": f"Bearer {api_key}"},
+                                 limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY,
+                                                     max_keepalive_connections=LLM_MAX_CONCURRENCY))
+        self.pool = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+        self.limiter = RateLimiter(LLM_REQUESTS_PER_MINUTE)
+        self.flights = {}  # sha1 of the request body -> Flight
+        self.lock = threading.Lock()
+
+    def chat(self, messages, model=None, temperature=0.0, stream=False, stop=None):
+        """Start (or join) a chat completion; iterate the returned Flight for the text"""
+        body = {"model": model or LLM_MODEL, "messages": messages, "temperature": temperature, "stream": stream}
+        if stop:
+            body["stop"] = stop
+        key = hashlib.sha1(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                metrics.increment("llm_requests_coalesced_total")
+                return flight
+            flight = self.flights[key] = Flight()
+        self.pool.submit(self._run, key, body, flight)
+        return flight
+
+    def _run(self, key, body, flight):
+        try:
+            usage = self._request(body, flight)
+            flight.finish(usage=usage)
+        except Exception as e:
+            flight.finish(error=e)
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+
+    def _request(self, body, flight):
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            self.limiter.acquire()
+            retry_after = None
+            try:
+                with metrics.span("llm.request"):
+                    if body["stream"]:
+                        with self.http.stream("POST", "chat/completions", json=body) as response:
+                            if response.status_code == 200:
+                                return self._read_stream(response, flight)
+                            response.read()
+                    else:
+                        response = self.http.post("chat/completions", json=body)
+                        if response.status_code == 200:
+                            payload = response.json()
+                            flight.add(payload["choices"][0]["message"]["content"] or "")
+                            return payload.get("usage") or {}
+                status = response.status_code
+                if status not in RETRY_STATUSES or attempt == LLM_MAX_RETRIES:
+                    raise LLMRequestError(f"LLM request failed with HTTP {status}: {response.text[:500]}", status)
+                retry_after = _retry_after(response)
+                reason = str(status)
+            except httpx.TransportError as e:
+                # A stream that already delivered text cannot be replayed to its readers
+                if flight.pieces or attempt == LLM_MAX_RETRIES:
+                    raise LLMRequestError(f"LLM request failed: {e}") from e
+                reason = type(e).__name__
+            delay = retry_after if retry_after is not None else \
+                min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if reason == "429":
+                self.limiter.pause(delay)
+            metrics.increment("llm_retries_total", reason=reason)
+            time.sleep(delay)
+
+    @staticmethod
+    def _read_stream(response, flight):
+        """Server-sent events of an OpenAI-style streamed completion; returns the usage if reported"""
+        usage = {}
+        for line in response.iter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            # OpenAI reports usage in a final event, Groq under x_groq
+            usage = event.get("usage") or (event.get("x_groq") or {}).get("usage") or usage
+            for choice in event.get("choices") or []:
+                piece = (choice.get("delta") or {}).get("content")
+                if piece:
+                    flight.add(piece)
+        return usage
+
+class AnswerStreamHandler(BaseCallbackHandler):
+    """Calls on_text(text so far) as tokens arrive, for LLM calls tagged tag only (not e.g. question condensing)"""
+
+    def __init__(self, tag, on_text):
+        self.tag = tag
+        # Not self.on_text: that is BaseCallbackHandler's hook for the formatted prompt
+        self._emit = on_text
+        self.runs = {}  # run_id -> text so far
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        if self.tag in (tags or []):
+            self.runs[run_id] = ""
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if run_id in self.runs:
+            self.runs[run_id] += token
+            self._emit(self.runs[run_id])
+
+def _retry_after(response):
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+def to_openai_messages(messages):
+    roles = {"human": "user", "ai": "assistant", "system": "system"}
+    return [{"role": roles.get(m.type, "user"), "content": str(m.content)} for m in messages]
+
+class PooledChatModel(BaseChatModel):
+    """
+    LangChain chat model on the shared LLMClient, used for LLM_BACKEND=groq.
+    With streaming (the default) every call streams, so callbacks receive on_llm_new_token
+    as text arrives, which is how answers are shown while they are generated.
+    """
+
+    api_key: str
+    base_url: Optional[str] = None
+    model_name: str = LLM_MODEL
+    temperature: float = 0.0
+    streaming: bool = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "pooled-openai-chat"
+
+    def _flight(self, messages, stop, stream):
+        return get_llm_client(self.api_key, self.base_url).chat(
+            to_openai_messages(messages), self.model_name, self.temperature, stream, stop)
+
+    def _stream(self, messages: List[Any], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        for piece in self._flight(messages, stop, True):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager is not None:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    def _generate(self, messages: List[Any], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        flight = self._flight(messages, stop, self.streaming)
+        pieces = []
+        for piece in flight:
+            pieces.append(piece)
+            if self.streaming and run_manager is not None:
+                run_manager.on_llm_new_token(piece, chunk=ChatGenerationChunk(message=AIMessageChunk(content=piece)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(pieces)))],
+                          llm_output={"token_usage": flight.usage, "model_name": self.model_name})
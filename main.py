@@ -1,8 +1,7 @@
 import streamlit as st
 from ui import render_ui
-from processing import load_and_process_documents, refine_question
 from utils import clean_text, store_feedback, generate_wordcloud, export_chat_to_pdf
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from warmup import lazy_import
 import json
 import tempfile
 import os
@@ -10,6 +9,10 @@ import os
 if __name__ == "__main__":
     st.set_page_config(page_title="📄 Advanced Multi-Doc Chat with Grok", layout="wide")
     os.environ['GROQ_API_KEY']="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"
-    render_ui(load_and_process_documents, refine_question, clean_text, store_feedback, generate_wordcloud, export_chat_to_pdf)
+    # processing loads langchain and the ingestion stack; it is imported at first use, after login
+    render_ui(lazy_import("processing", "load_and_process_documents"), lazy_import("processing", "refine_question"),
+              clean_text, store_feedback, generate_wordcloud, export_chat_to_pdf,
+              lazy_import("processing", "attach_index_artifacts"), lazy_import("processing", "save_uploads"),
+              lazy_import("processing", "attach_ingestion_job"))
 
   
@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from uuid import UUID
+from typing import Any, Dict, List
+import numpy as np
+from langchain.callbacks.base import BaseCallbackHandler
+
+# Histogram upper bounds in seconds for the Prometheus export
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Recent durations kept per stage for the percentiles in the diagnostics panel and JSON export
+RECENT_SAMPLES = 1024
+METRIC_PREFIX = "rag"
+# Minimum time between two rewrites of the export files by export_if_due
+METRICS_EXPORT_SECONDS = float(os.environ.get("METRICS_EXPORT_SECONDS", "5"))
+
+class Metrics:
+    """
+    Process-wide timing spans and counters, shared by every session.
+    Each span name keeps a cumulative histogram plus a window of recent durations;
+    trace() additionally collects the spans one request observes on its thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}  # name -> {"count", "sum", "max", "buckets", "recent"}
+        self.counters = {}  # (name, ((label, value), ...)) -> value
+        self._local = threading.local()
+        self._exported_at = {}  # directory -> time.monotonic() of its last export
+
+    def observe(self, name, seconds):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(LATENCY_BUCKETS),
+                                             "recent": deque(maxlen=RECENT_SAMPLES)}
+            stage["count"] += 1
+            stage["sum"] += seconds
+            stage["max"] = max(stage["max"], seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stage["buckets"][i] += 1
+            stage["recent"].append(seconds)
+        spans = getattr(self._local, "spans", None)
+        if spans is not None:
+            spans.append((name, seconds))
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def current_trace(self):
+        """The span list of the trace active on this thread, if any, to hand to worker threads"""
+        return getattr(self._local, "spans", None)
+
+    @contextmanager
+    def continue_trace(self, spans):
+        """Record this thread's spans into another thread's trace (spans from current_trace())"""
+        previous = getattr(self._local, "spans", None)
+        self._local.spans = spans
+        try:
+            yield
+        finally:
+            self._local.spans = previous
+
+    @contextmanager
+    def trace(self):
+        """Collect the (name, seconds) spans observed on this thread while the block runs, e.g. one Submit"""
+        previous = getattr(self._local, "spans", None)
+        spans = self._local.spans = []
+        try:
+            yield spans
+        finally:
+            self._local.spans = previous
+
+    def snapshot(self):
+        with self.lock:
+            stages = {name: dict(stage, recent=list(stage["recent"]), buckets=list(stage["buckets"]))
+                      for name, stage in self.stages.items()}
+            counters = dict(self.counters)
+        summary = {}
+        for name, stage in sorted(stages.items()):
+            recent = np.asarray(stage["recent"]) * 1000
+            summary[name] = {"count": stage["count"], "total_seconds": stage["sum"], "max_ms": stage["max"] * 1000,
+                             "p50_ms": float(np.percentile(recent, 50)), "p95_ms": float(np.percentile(recent, 95)),
+                             "p99_ms": float(np.percentile(recent, 99)), "buckets": stage["buckets"]}
+        return {"timestamp": time.time(), "stages": summary,
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(counters.items())]}
+
+    def to_prometheus(self, snapshot=None):
+        """Prometheus text exposition format (version 0.0.4)"""
+        snapshot = snapshot or self.snapshot()
+        histogram = f"{METRIC_PREFIX}_stage_duration_seconds"
+        lines = [f"# HELP {histogram} Duration of each processing stage.", f"# TYPE {histogram} histogram"]
+        for name, stage in snapshot["stages"].items():
+            label = _escape(name)
+            for bound, count in zip(LATENCY_BUCKETS, stage["buckets"]):
+                lines.append(f'{histogram}_bucket{{stage="{label}",le="{bound}"}} {count}')
+            lines.append(f'{histogram}_bucket{{stage="{label}",le="+Inf"}} {stage["count"]}')
+            lines.append(f'{histogram}_sum{{stage="{label}"}} {stage["total_seconds"]}')
+            lines.append(f'{histogram}_count{{stage="{label}"}} {stage["count"]}')
+        typed = set()
+        for counter in snapshot["counters"]:
+            metric = f"{METRIC_PREFIX}_{counter['name']}"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            labels = ",".join(f'{key}="{_escape(value)}"' for key, value in counter["labels"].items())
+            lines.append(f"{metric}{{{labels}}} {counter['value']}" if labels else f"{metric} {counter['value']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, directory):
+        """Write metrics.prom (for a textfile collector) and metrics.json into directory, atomically"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        snapshot = self.snapshot()
+        for name, content in (("metrics.prom", self.to_prometheus(snapshot)), ("metrics.json", json.dumps(snapshot, indent=2))):
+            tmp_path = directory / f"{name}.tmp{os.getpid()}"
+            tmp_path.write_text(content, encoding="utf-8")
+            os.replace(tmp_path, directory / name)
+
+    def export_if_due(self, directory, interval=METRICS_EXPORT_SECONDS):
+        """export(directory) unless it was exported less than interval seconds ago; returns whether it was"""
+        key = str(Path(directory).resolve())
+        now = time.monotonic()
+        with self.lock:
+            # Claimed before writing, so concurrent reruns of other sessions skip instead of waiting
+            if now - self._exported_at.get(key, -interval) < interval:
+                return False
+            self._exported_at[key] = now
+        self.export(directory)
+        return True
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records every LLM call as an llm.call span, with call and token counters"""
+
+    def __init__(self):
+        self.starts = {}
+        self.prompt_chars = {}
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self.starts[run_id] = time.perf_counter()
+        self.prompt_chars[run_id] = sum(len(p) for p in prompts)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any) -> None:
+        self.starts[run_id] = time.perf_counter()
+        self.prompt_chars[run_id] = sum(len(str(m.content)) for batch in messages for m in batch)
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        start = self.starts.pop(run_id, None)
+        prompt_chars = self.prompt_chars.pop(run_id, 0)
+        if start is not None:
+            metrics.observe("llm.call", time.perf_counter() - start)
+        metrics.increment("llm_calls_total")
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage:
+            metrics.increment("llm_prompt_tokens_total", usage.get("prompt_tokens", 0))
+            metrics.increment("llm_completion_tokens_total", usage.get("completion_tokens", 0))
+        else:
+            # No usage reported (e.g. the fake model): roughly four characters per token
+            completion_chars = sum(len(g.text) for batch in response.generations for g in batch)
+            metrics.increment("llm_prompt_tokens_total", prompt_chars // 4)
+            metrics.increment("llm_completion_tokens_total", completion_chars // 4)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self.starts.pop(run_id, None)
+        self.prompt_chars.pop(run_id, None)
+        metrics.increment("llm_errors_total")
@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+from langchain.schema import Document
+
+# "auto" uses Tesseract when its binary is installed and falls back to EasyOCR
+OCR_ENGINE = os.environ.get("OCR_ENGINE", "auto")
+OCR_LANGUAGES = os.environ.get("OCR_LANGUAGES", "en").split(",")
+OCR_DPI = int(os.environ.get("OCR_DPI", "200"))
+# Pages rendered and recognised together; bounds memory on large scans
+OCR_BATCH_PAGES = int(os.environ.get("OCR_BATCH_PAGES", "8"))
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+_reader = None
+
+def resolve_engine(engine=None):
+    engine = engine or OCR_ENGINE
+    if engine == "auto":
+        try:
+            import pytesseract  # noqa: F401
+            return "tesseract" if shutil.which("tesseract") else "easyocr"
+        except ImportError:
+            return "easyocr"
+    if engine not in ("tesseract", "easyocr"):
+        raise ValueError(f"Unknown OCR engine: {engine}")
+    return engine
+
+def ocr_cache_path(cache_dir, file_hash):
+    """Page texts of one file, kept apart from the document cache so a new embedding model does not redo OCR"""
+    return Path(cache_dir) / "ocr" / f"{file_hash}-{resolve_engine()}.json"
+
+def recognize(images, engine=None):
+    """Text of each PIL image; the EasyOCR model is loaded once per (worker) process"""
+    global _reader
+    engine = resolve_engine(engine)
+    if engine == "tesseract":
+        import pytesseract
+        return [pytesseract.image_to_string(image, lang="+".join(_tesseract_language(l) for l in OCR_LANGUAGES))
+                for image in images]
+    if _reader is None:
+        import easyocr
+        _reader = easyocr.Reader(OCR_LANGUAGES, gpu=False, verbose=False)
+    return ["\n".join(_reader.readtext(np.asarray(image.convert("RGB")), detail=0, paragraph=True)) for image in images]
+
+def _tesseract_language(code):
+    return {"en": "eng", "de": "deu", "fr": "fra", "es": "spa", "it": "ita", "pt": "por"}.get(code, code)
+
+def page_images(filepath, pages):
+    """PIL images of the given 0-based pages of a PDF (None for blank pages), or of the image file itself"""
+    from PIL import Image
+    if str(filepath).lower().endswith(IMAGE_EXTENSIONS):
+        return [Image.open(filepath)]
+    try:
+        import fitz
+        with fitz.open(filepath) as pdf:
+            images = []
+            for page in pages:
+                pixmap = pdf[page].get_pixmap(dpi=OCR_DPI)
+                images.append(Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples))
+            return images
+    except ImportError:
+        # Without PyMuPDF, OCR the largest embedded image of each page (a scan is one full-page image)
+        from pypdf import PdfReader
+        reader = PdfReader(filepath)
+        images = []
+        for page in pages:
+            embedded = [image.image for image in reader.pages[page].images]
+            # A page with neither text nor images is blank: None, nothing to recognise
+            images.append(max(embedded, key=lambda image: image.width * image.height) if embedded else None)
+        return images
+
+def with_ocr(docs, filepath, file_name, cache_path=None, timings=None):
+    """
+    Pass page Documents through, replacing pages without a text layer by their OCR text.
+    Pages needing OCR are collected into batches of OCR_BATCH_PAGES; pages after the first
+    one in a batch are held back too, so page order is kept. Pages that stay empty are dropped
+    instead of producing empty chunks. Recognised pages are cached in cache_path (JSON).
+    """
+    cache = {}
+    if cache_path is not None:
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+    cache_size = len(cache)
+    pending, missing = [], []
+
+    def flush():
+        if missing:
+            start = time.perf_counter()
+            images = page_images(filepath, missing)
+            texts = iter(recognize([image for image in images if image is not None]))
+            for page, image in zip(missing, images):
+                cache[str(page)] = next(texts) if image is not None else ""
+            if timings is not None:
+                timings["ingest.ocr"] = timings.get("ingest.ocr", 0.0) + time.perf_counter() - start
+        for doc in pending:
+            yield from flush_one(doc)
+        pending.clear()
+        missing.clear()
+
+    def flush_one(doc):
+        if not doc.page_content.strip():
+            doc.page_content = cache.get(str(doc.metadata.get("page", 0)), "")
+            doc.metadata["ocr"] = True
+        if doc.page_content.strip():
+            yield doc
+
+    for doc in docs:
+        if doc.page_content.strip():
+            if pending:
+                pending.append(doc)
+            else:
+                yield doc
+            continue
+        page = doc.metadata.get("page", 0)
+        if str(page) in cache and not pending:
+            yield from flush_one(doc)
+            continue
+        pending.append(doc)
+        if str(page) not in cache:
+            missing.append(page)
+        if len(missing) >= OCR_BATCH_PAGES or len(pending) >= 4 * OCR_BATCH_PAGES:
+            yield from flush()
+    yield from flush()
+
+    if cache_path is not None and len(cache) > cache_size:
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(f"{cache_path}.tmp{os.getpid()}")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+
+def image_documents(file_name):
+    """A single empty page for an image upload, filled in by with_ocr"""
+    return [Document(page_content="", metadata={"source": file_name, "page": 0})]
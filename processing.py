@@ -1,26 +1,106 @@
 import streamlit as st
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, CSVLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import FAISS
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.chains import ConversationalRetrievalChain
-from langchain.memory import ConversationBufferMemory
-from langchain_groq import ChatGroq
-from langchain.retrievers.ensemble import EnsembleRetriever
-from langchain.retrievers import BM25Retriever
 import os
 import tempfile
 import shutil
-import hashlib
 from pathlib import Path
-from utils import clean_text
+from ingestion import SUPPORTED_EXTENSIONS, CACHE_SIGNATURE, save_upload, ingest_files
+from indexing import update_document_set, resolve_index_artifacts, doc_cache_path
+from bm25_index import BM25Index
+from vector_store import VectorIndex
+from embedding_service import get_embedding_service
+from retrieval import HybridRetriever
+from metrics import metrics, MetricsCallbackHandler
+from llm_client import ANSWER_TAG, PooledChatModel
+from index_registry import get_index_registry
+from conversation_memory import TokenBudgetMemory, MEMORY_TOKEN_BUDGET
+from answer_cache import document_set_key
+from storage_manager import get_storage_manager, mark_used
 import re
 import json
 
-@st.cache_resource(show_spinner=False)
-def load_and_process_documents(uploaded_files, groq_api_key, dirs):
+# "groq" calls the Groq API (or LLM_BASE_URL) through the shared llm_client;
+# "fake" uses the deterministic local FakeChatModel (offline runs, benchmarks)
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "groq")
+FAKE_LLM_LATENCY_SECONDS = float(os.environ.get("FAKE_LLM_LATENCY_SECONDS", "0"))
+
+def make_llm(groq_api_key):
+    if LLM_BACKEND == "fake":
+        from fake_llm import FakeChatModel
+        return FakeChatModel(latency=FAKE_LLM_LATENCY_SECONDS, callbacks=[MetricsCallbackHandler()])
+    # Cheap to create: the HTTP connections, rate limit and in-flight requests live in the shared client
+    return PooledChatModel(api_key=groq_api_key, temperature=0, callbacks=[MetricsCallbackHandler()])
+
+def build_qa_chain(vector_index, bm25_index, groq_api_key, memory=None):
+    """Hybrid vector + BM25 retriever and a conversational QA chain over it; pass memory to carry a conversation over"""
+    # Both indexes are partitioned by file hash so a file selection can be pushed into the search
+    hybrid_retriever = HybridRetriever(vector_index=vector_index, bm25_index=bm25_index,
+                                       embeddings=get_embedding_service(), k=3, weights=[0.5, 0.5])
+
+    llm = make_llm(groq_api_key)
+    if memory is None:
+        # ConversationBufferMemory ignored k and grew without bound; this keeps the condense prompt flat
+        memory = TokenBudgetMemory(llm=llm, memory_key="chat_history", return_messages=True,
+                                   max_token_limit=MEMORY_TOKEN_BUDGET)
+
+    qa_chain = ConversationalRetrievalChain.from_llm(
+        llm=llm,
+        retriever=hybrid_retriever,
+        memory=memory
+    )
+    qa_chain.combine_docs_chain.llm_chain.tags = [ANSWER_TAG]
+    return llm, qa_chain, hybrid_retriever
+
+def lease_session_indexes(lease):
+    """Make lease the session's index lease, releasing the one it replaces"""
+    previous = st.session_state.get("index_lease")
+    st.session_state.index_lease = lease
+    if previous is not None and previous is not lease:
+        previous.release()
+
+def save_uploads(uploaded_files, uploads_dir):
+    """
+    Save the uploads under uploads_dir by content hash (save_upload); files already there are not written again.
+    Returns (file_names, files) where files holds a (file_name, file_hash, filepath) per supported upload.
+    """
+    file_names, files = [], []
+    with metrics.span("ingest.save_uploads"):
+        for file in uploaded_files:
+            file_names.append(file.name)
+            if not file.name.endswith(SUPPORTED_EXTENSIONS):
+                continue
+            file_hash, filepath = save_upload(file, uploads_dir, file.name)
+            files.append((file.name, file_hash, filepath))
+    return file_names, files
+
+def lease_document_set(file_hashes, cache_dir, file_names=None):
+    """
+    Lease the indexes of a document set from the index registry, building them from the document cache if needed.
+    Each document set has its own index directory, so sessions never overwrite each other's;
+    a new one starts from the closest existing set and only the difference is indexed.
+    file_names ({file_hash: name}) labels the set in the storage panel.
+    """
+    docset = document_set_key(file_hashes)
+    index_dir = Path(cache_dir) / "indexes" / docset
+
+    lease = get_index_registry().acquire(
+        docset, lambda: update_document_set(index_dir, file_hashes, cache_dir, CACHE_SIGNATURE))
+    # Storage eviction is least recently used first, by mtime
+    mark_used(index_dir)
+    for file_hash in file_hashes:
+        mark_used(doc_cache_path(cache_dir, file_hash))
+    if file_names:
+        with open(index_dir / "files.json", "w", encoding="utf-8") as f:
+            json.dump(file_names, f, ensure_ascii=False)
+    return lease
+
+def load_and_process_documents(uploaded_files, groq_api_key, dirs, workers=None):
+    """
+    Ingest uploads and build this session's chain over the indexes of its document set.
+    Sessions uploading the same files share one loaded copy of the indexes through the
+    index registry; chains and memory stay per session.
+    """
     with st.spinner("Processing documents..."):
-        all_chunks = []
         tmp_dir = tempfile.mkdtemp(dir=dirs["temp_dir"])
         
         try:
@@ -30,64 +110,28 @@ def load_and_process_documents(uploaded_files, groq_api_key, dirs):
             if "last_file_hashes" not in st.session_state:
                 st.session_state.last_file_hashes = []
 
-            file_hashes = [hashlib.md5(file.getbuffer()).hexdigest() for file in uploaded_files]
-            file_names = [file.name for file in uploaded_files]
-
-            for file in uploaded_files:
-                filepath = os.path.join(dirs["uploads_dir"], file.name)
-                file_hash = hashlib.md5(file.getbuffer()).hexdigest()
-                if file_hash not in st.session_state.processed_docs:
-                    with open(filepath, "wb") as f:
-                        f.write(file.getbuffer())
-                    if file.name.endswith(".pdf"):
-                        loader = PyPDFLoader(filepath)
-                    elif file.name.endswith(".txt"):
-                        loader = TextLoader(filepath)
-                    elif file.name.endswith(".csv"):
-                        loader = CSVLoader(filepath)
-                    else:
-                        continue
-                    docs = loader.load()
-                    for doc in docs:
-                        doc.page_content = clean_text(doc.page_content)
-                        doc.metadata['source'] = file.name  # Ensure source is in metadata
-                    splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=100)
-                    chunks = splitter.split_documents(docs)
-                    st.session_state.processed_docs[file_hash] = {
-                        "chunks": chunks,
-                        "file_name": file.name
-                    }
-                all_chunks.extend(st.session_state.processed_docs[file_hash]["chunks"])
-
-            embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-            faiss_index_path = dirs["cache_dir"] / "faiss_index"
-            cache_valid = os.path.exists(faiss_index_path) and st.session_state.get("last_file_hashes") == file_hashes
-            
-            if cache_valid:
-                faiss_store = FAISS.load_local(str(faiss_index_path), embeddings, allow_dangerous_deserialization=True)
-            else:
-                faiss_store = FAISS.from_documents(all_chunks, embeddings)
-                faiss_store.save_local(str(faiss_index_path))
-                st.session_state.last_file_hashes = file_hashes
-
-            bm25_retriever = BM25Retriever.from_documents(all_chunks)
-            bm25_retriever.k = 3
-
-            hybrid_retriever = EnsembleRetriever(
-                retrievers=[faiss_store.as_retriever(search_kwargs={"k": 3}), bm25_retriever],
-                weights=[0.5, 0.5]
-            )
-
-            llm = ChatGroq(temperature=0, groq_api_key=groq_api_key, model_name="Llama3-8b-8192")
-            memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True, k=3)
-
-            qa_chain = ConversationalRetrievalChain.from_llm(
-                llm=llm,
-                retriever=hybrid_retriever,
-                memory=memory
-            )
-
-            return llm, qa_chain, hybrid_retriever, file_names, all_chunks  # Return chunks for reference
+            # One model per process, shared by every session
+            embeddings = get_embedding_service()
+
+            file_names, files = save_uploads(uploaded_files, dirs["uploads_dir"])
+            file_hashes = [file_hash for _, file_hash, _ in files]
+
+            with metrics.span("ingest.files"):
+                processed = ingest_files(files, dirs["cache_dir"], embeddings, workers)
+            st.session_state.processed_docs.update(processed)
+            # Files that could not be read are left out of the set
+            file_hashes = [file_hash for file_hash in file_hashes if file_hash in processed]
+            if not file_hashes:
+                raise ValueError("None of the uploaded files could be processed")
+
+            lease = lease_document_set(file_hashes, dirs["cache_dir"],
+                                       {file_hash: file_name for file_name, file_hash, _ in files})
+            lease_session_indexes(lease)
+            get_storage_manager(dirs).enforce()
+            st.session_state.last_file_hashes = file_hashes
+
+            llm, qa_chain, hybrid_retriever = build_qa_chain(lease.vector_index, lease.bm25_index, groq_api_key)
+            return llm, qa_chain, hybrid_retriever, file_names, len(lease.bm25_index)
 
         finally:
             try:
@@ -95,6 +139,47 @@ def load_and_process_documents(uploaded_files, groq_api_key, dirs):
             except Exception as e:
                 st.warning(f"Could not clean up temp dir: {e}")
 
+def load_index_artifacts(artifacts_dir, version=None):
+    """Lease prebuilt artifacts from the index registry; the indexes are read-only and shared by sessions"""
+    version_dir, manifest = resolve_index_artifacts(artifacts_dir, version)
+    if manifest["signature"] != CACHE_SIGNATURE:
+        raise ValueError(f"Index was built with {manifest['signature']}, this app uses {CACHE_SIGNATURE}")
+    lease = get_index_registry().acquire(
+        f"artifacts:{Path(version_dir).resolve()}",
+        lambda: (VectorIndex.open(version_dir / "vector_index"), BM25Index.load(version_dir / "bm25_index")))
+    return lease, manifest
+
+def attach_index_artifacts(artifacts_dir, groq_api_key, version=None):
+    """Use artifacts written by build_index.py instead of ingesting uploads; same return value as load_and_process_documents"""
+    lease, manifest = load_index_artifacts(str(artifacts_dir), version)
+    lease_session_indexes(lease)
+    st.session_state.processed_docs = {f["hash"]: {"file_name": f["name"], "chunk_count": f["chunks"]} for f in manifest["files"]}
+    st.session_state.last_file_hashes = [f["hash"] for f in manifest["files"]]
+    # Each session gets its own chain and memory over the shared indexes
+    llm, qa_chain, hybrid_retriever = build_qa_chain(lease.vector_index, lease.bm25_index, groq_api_key)
+    return llm, qa_chain, hybrid_retriever, [f["name"] for f in manifest["files"]], len(lease.bm25_index)
+
+def attach_ingestion_job(job, groq_api_key, dirs):
+    """
+    Point the session at the files a background IngestionJob has finished so far.
+    Returns the same tuple as load_and_process_documents, or None when there is nothing
+    new since the last call. The conversation memory is kept while the job grows the set.
+    """
+    ready = job.ready()
+    if ready is None or st.session_state.get("ingest_job_version") == (job.id, ready["version"]):
+        return None
+    file_hashes = [file_hash for _, file_hash, _ in ready["files"]]
+    lease = lease_document_set(file_hashes, dirs["cache_dir"])
+    lease_session_indexes(lease)
+    st.session_state.ingest_job_version = (job.id, ready["version"])
+    st.session_state.processed_docs.update({file_hash: {"file_name": name, "chunk_count": chunk_count}
+                                            for name, file_hash, chunk_count in ready["files"]})
+    st.session_state.last_file_hashes = file_hashes
+    qa_chain = st.session_state.get("qa_chain")
+    memory = qa_chain.memory if qa_chain is not None and ready["version"] > 1 else None
+    llm, qa_chain, hybrid_retriever = build_qa_chain(lease.vector_index, lease.bm25_index, groq_api_key, memory)
+    return llm, qa_chain, hybrid_retriever, [name for name, _, _ in ready["files"]], len(lease.bm25_index)
+
 def refine_question(base_question, llm, selected_files=None, all_file_names=None):
     """
     Refines the user query based on selected files or all files.
@@ -113,5 +198,6 @@ User's question: {base_question}
 Return the final refined question or response:
 """
 
-    refined_response = llm.invoke(prompt.strip())
+    with metrics.span("submit.refine"):
+        refined_response = llm.invoke(prompt.strip())
     return refined_response.content.strip()
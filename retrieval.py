@@ -0,0 +1,141 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+import numpy as np
+from langchain.schema import BaseRetriever, Document
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+from metrics import metrics
+
+# Same constant as EnsembleRetriever's reciprocal rank fusion
+RRF_K = 60
+FUSION_METHODS = ("rrf", "weighted")
+RETRIEVAL_THREADS = int(os.environ.get("RETRIEVAL_THREADS", "8"))
+
+_dense_pool = ThreadPoolExecutor(max_workers=RETRIEVAL_THREADS, thread_name_prefix="dense-search")
+
+def fuse_rankings(rankings, weights, method="rrf"):
+    """
+    Fuse ranked candidate lists into one, best first.
+    rankings holds one (chunk_ids, scores) pair per retriever, best first and higher scores better.
+    "rrf" adds weight / (RRF_K + rank); "weighted" adds weight * the min-max normalized score.
+    A chunk found by several retrievers is one candidate whose contributions add up.
+    Returns (chunk_ids, fused_scores).
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method: {method}")
+    ids = list(dict.fromkeys(chunk_id for chunk_ids, _ in rankings for chunk_id in chunk_ids))
+    position = {chunk_id: n for n, chunk_id in enumerate(ids)}
+    fused = np.zeros(len(ids), dtype=np.float64)
+    for (chunk_ids, scores), weight in zip(rankings, weights):
+        if not len(chunk_ids):
+            continue
+        index = np.fromiter((position[chunk_id] for chunk_id in chunk_ids), dtype=np.int64, count=len(chunk_ids))
+        if method == "rrf":
+            contribution = weight / (RRF_K + np.arange(1, len(chunk_ids) + 1))
+        else:
+            scores = np.asarray(scores, dtype=np.float64)
+            low, high = scores.min(), scores.max()
+            contribution = weight * ((scores - low) / (high - low) if high > low else np.ones(len(scores)))
+        # Ids are unique within one ranking, so a plain fancy-index add is safe
+        fused[index] += contribution
+    order = np.argsort(-fused, kind="stable")
+    return [ids[i] for i in order], fused[order]
+
+class HybridRetriever(BaseRetriever):
+    """
+    Dense + BM25 retrieval over a VectorIndex and a BM25Index in one retriever.
+    The dense search (query embedding + vector search) runs on a worker thread while BM25
+    runs on the caller's; each returns fetch_k candidates and the two rankings are fused
+    with fuse_rankings. Chunks with the same text (e.g. the same page in two uploads) are
+    returned once. k, weights, fusion and groups belong to the instance: configure_retriever
+    makes a per-request copy instead of changing a retriever other sessions use.
+    """
+
+    vector_index: Any
+    bm25_index: Any
+    embeddings: Any
+    k: int = 3
+    weights: List[float] = [0.5, 0.5]
+    fusion: str = "rrf"
+    fetch_k: Optional[int] = None
+    groups: Optional[List[str]] = None
+
+    def _dense(self, query, fetch_k, spans):
+        with metrics.continue_trace(spans):
+            with metrics.span("retrieve.embed_query"):
+                vector = self.embeddings.embed_query(query)
+            with metrics.span("retrieve.vector"):
+                hits = self.vector_index.search(vector, fetch_k, self.groups)
+        # Nearest first; distances negated so that higher is better
+        return [self.vector_index.chunk_id(row) for row, _ in hits], [-distance for _, distance in hits]
+
+    def _lexical(self, query, fetch_k):
+        with metrics.span("retrieve.bm25"):
+            hits = self.bm25_index.search(query, fetch_k, self.groups)
+        return [chunk_id for chunk_id, _ in hits], [score for _, score in hits]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        fetch_k = self.fetch_k or max(4 * self.k, 20)
+        with metrics.span("retrieve.hybrid"):
+            dense = _dense_pool.submit(self._dense, query, fetch_k, metrics.current_trace())
+            lexical = self._lexical(query, fetch_k)
+            dense = dense.result()
+            with metrics.span("retrieve.fusion"):
+                chunk_ids, _ = fuse_rankings([dense, lexical], self.weights, self.fusion)
+                documents, seen = [], set()
+                for chunk_id in chunk_ids:
+                    document = self.vector_index.get_document(chunk_id)
+                    if document.page_content in seen:
+                        continue
+                    seen.add(document.page_content)
+                    documents.append(document)
+                    if len(documents) == self.k:
+                        break
+        metrics.increment("retrieved_chunks_total", len(dense[0]), retriever="vector")
+        metrics.increment("retrieved_chunks_total", len(lexical[0]), retriever="bm25")
+        return documents
+
+def configure_retriever(hybrid_retriever, file_hashes=None, k=None, weights=None, fusion=None):
+    """
+    Per-request copy of the session's hybrid retriever with the given settings.
+    The original is left untouched; file_hashes limits both searches to those files
+    (empty means all files) and omitted settings keep their current values.
+    """
+    update = {}
+    if file_hashes:
+        update["groups"] = list(file_hashes)
+    if k is not None:
+        update["k"] = k
+    if weights is not None:
+        update["weights"] = list(weights)
+    if fusion is not None:
+        update["fusion"] = fusion
+    return hybrid_retriever.copy(update=update) if update else hybrid_retriever
+
+def with_retriever(qa_chain, retriever, condense=True):
+    """
+    A ConversationalRetrievalChain identical to qa_chain (same LLM chains and memory) but using retriever.
+    With condense=False the question is taken as already standalone (see condense_question)
+    and is not rewritten against the conversation again.
+    """
+    return ConversationalRetrievalChain(
+        combine_docs_chain=qa_chain.combine_docs_chain,
+        question_generator=qa_chain.question_generator,
+        retriever=retriever,
+        memory=qa_chain.memory,
+        get_chat_history=None if condense else (lambda chat_history: "")
+    )
+
+def condense_question(qa_chain, question):
+    """
+    Standalone form of question given the conversation in qa_chain's memory, rewritten by its
+    question generator as the chain itself would; the question as is when there is no conversation.
+    """
+    chat_history = _get_chat_history(qa_chain.memory.load_memory_variables({})[qa_chain.memory.memory_key])
+    if not chat_history:
+        return question
+    with metrics.span("submit.condense"):
+        generator = qa_chain.question_generator
+        return generator.invoke({"question": question, "chat_history": chat_history})[generator.output_key].strip()
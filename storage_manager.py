@@ -0,0 +1,219 @@
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from index_registry import get_index_registry
+from answer_cache import clear_answer_cache
+
+# Byte budget of each working directory; least recently used entries are evicted beyond it
+STORAGE_BUDGETS_MB = {
+    "uploads_dir": float(os.environ.get("STORAGE_UPLOADS_BUDGET_MB", "2048")),
+    "temp_dir": float(os.environ.get("STORAGE_TEMP_BUDGET_MB", "1024")),
+    "cache_dir": float(os.environ.get("STORAGE_CACHE_BUDGET_MB", "8192")),
+}
+# Entries touched more recently than this are not evicted to meet a budget, so in-flight uploads and writes are safe
+STORAGE_MIN_AGE_SECONDS = float(os.environ.get("STORAGE_MIN_AGE_SECONDS", "600"))
+# How long a directory scan is reused by the sidebar
+STORAGE_SCAN_SECONDS = 30
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+def get_storage_manager(dirs):
+    """Return the process-wide StorageManager for the directories from setup_directories()"""
+    key = str(Path(dirs["base_dir"]).resolve())
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = StorageManager(dirs)
+        return _managers[key]
+
+def mark_used(path):
+    """Record a use of a cache entry; recency is the entry's mtime, so an LRU needs no separate log"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def disk_usage(path):
+    """Bytes used by a file or directory tree"""
+    path = Path(path)
+    try:
+        if not path.is_dir():
+            return path.stat().st_size
+    except OSError:
+        return 0
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
+class StorageManager:
+    """
+    Keeps uploads, temp and cache directories within their byte budgets.
+    Each directory is divided into entries evicted as a whole, oldest use first: in the
+    cache a document cache (chunks, embeddings, OCR text and any partial entry of one file)
+    or the indexes of one document set; in uploads and temp each top-level file or folder.
+    Indexes a session holds, files of running ingestion jobs and anything used within
+    STORAGE_MIN_AGE_SECONDS are kept; the answer cache is only emptied by clear().
+    """
+
+    def __init__(self, dirs):
+        self.dirs = {name: Path(dirs[name]) for name in STORAGE_BUDGETS_MB}
+        self.budgets = {name: int(mb * 1024 * 1024) for name, mb in STORAGE_BUDGETS_MB.items()}
+        self.lock = threading.Lock()
+        self._usage = None
+        self._usage_at = 0.0
+
+    def entries(self, name):
+        """Evictable entries of one directory as {"paths", "bytes", "last_used", "kind", "key"}"""
+        root = self.dirs[name]
+        if name != "cache_dir":
+            return [self._entry([path], "file", path.name) for path in self._children(root)]
+        entries = [self._entry([path], "index", path.name) for path in self._children(root / "indexes")]
+        documents = {}
+        for path in self._children(root / "docs"):
+            documents.setdefault(path.name.split(".", 1)[0], []).append(path)
+        for path in self._children(root / "ocr"):
+            documents.setdefault(path.name.split("-", 1)[0], []).append(path)
+        entries.extend(self._entry(paths, "document", file_hash) for file_hash, paths in documents.items())
+        return entries
+
+    @staticmethod
+    def _children(directory):
+        try:
+            return [directory / child for child in os.listdir(directory)]
+        except OSError:
+            return []
+
+    @staticmethod
+    def _entry(paths, kind, key):
+        last_used = 0.0
+        for path in paths:
+            try:
+                last_used = max(last_used, path.stat().st_mtime)
+            except OSError:
+                continue
+        return {"paths": paths, "bytes": sum(disk_usage(path) for path in paths), "last_used": last_used,
+                "kind": kind, "key": key}
+
+    def protected(self):
+        """Keys and paths that must not be evicted right now"""
+        from ingestion_jobs import get_ingestion_queue
+        from indexing import busy_index_dirs
+        keys, paths = set(), set()
+        for stats in get_index_registry().stats():
+            if stats["refs"] > 0:
+                # A job's index directory is named after all its files, its snapshots after those finished
+                keys.add(stats["key"])
+                paths.add(Path(stats["path"]).resolve())
+        for file_name, file_hash, filepath in get_ingestion_queue().active_files():
+            keys.add(file_hash)
+            paths.add(Path(filepath).resolve())
+        paths.update(Path(index_dir).resolve() for index_dir in get_ingestion_queue().active_index_dirs())
+        for index_dir in busy_index_dirs():
+            # Also covers the staging copies next to it, named <set>.tmp<...>
+            keys.add(index_dir.name)
+            paths.add(index_dir)
+        return keys, paths
+
+    def enforce(self, names=None, budgets=None, min_age=None):
+        """Evict least recently used entries until each directory is within budget; returns bytes freed"""
+        with self.lock:
+            keys, paths = self.protected()
+            now = time.time()
+            freed = 0
+            for name in names or self.dirs:
+                budget = (budgets or self.budgets)[name]
+                entries = sorted(self.entries(name), key=lambda entry: entry["last_used"])
+                total = sum(entry["bytes"] for entry in entries)
+                for entry in entries:
+                    if total <= budget:
+                        break
+                    if (entry["key"].split(".", 1)[0] in keys or any(path.resolve() in paths for path in entry["paths"])
+                            or now - entry["last_used"] < (STORAGE_MIN_AGE_SECONDS if min_age is None else min_age)):
+                        continue
+                    # An idle loaded copy is dropped with its files; one leased in the meantime is kept
+                    if entry["kind"] == "index" and not all(
+                            get_index_registry().discard(key) for key in self._registry_keys(entry)):
+                        continue
+                    for path in entry["paths"]:
+                        if path.is_dir():
+                            shutil.rmtree(path, ignore_errors=True)
+                        else:
+                            try:
+                                path.unlink()
+                            except OSError:
+                                pass
+                    total -= entry["bytes"]
+                    freed += entry["bytes"]
+            self._usage = None
+        return freed
+
+    @staticmethod
+    def _registry_keys(entry):
+        """Registry keys loaded from an index entry's directory, which include its own name"""
+        index_dir = entry["paths"][0].resolve()
+        return {entry["key"]} | {stats["key"] for stats in get_index_registry().stats()
+                                 if Path(stats["path"]).resolve() == index_dir}
+
+    def clear(self, name):
+        """
+        Evict every entry of a directory that is not in use, however recently used; clearing
+        the cache directory also empties the answer cache. Returns bytes freed.
+        """
+        freed = self.enforce([name], {name: 0}, min_age=0)
+        if name == "cache_dir":
+            freed += clear_answer_cache(self.dirs[name])
+        return freed
+
+    def usage(self, refresh=False):
+        """
+        Bytes used and budget per directory, plus per document set the size of its indexes and
+        of the document caches of its files (a file shared by several sets counts in each).
+        Scans are reused for STORAGE_SCAN_SECONDS unless refresh is set.
+        """
+        with self.lock:
+            if not refresh and self._usage is not None and time.time() - self._usage_at < STORAGE_SCAN_SECONDS:
+                return self._usage
+        in_use = {Path(stats["path"]).resolve() for stats in get_index_registry().stats() if stats["refs"] > 0}
+        directories = {name: {"bytes": disk_usage(path), "budget": self.budgets[name]} for name, path in self.dirs.items()}
+        cache = self.entries("cache_dir")
+        documents = {entry["key"]: entry for entry in cache if entry["kind"] == "document"}
+        docsets = []
+        for entry in cache:
+            if entry["kind"] != "index":
+                continue
+            index_dir = entry["paths"][0]
+            try:
+                with open(index_dir / "vector_index" / "meta.json", "r", encoding="utf-8") as f:
+                    file_hashes = list(json.load(f)["files"])
+            except (OSError, ValueError, KeyError):
+                file_hashes = []
+            try:
+                with open(index_dir / "files.json", "r", encoding="utf-8") as f:
+                    names = json.load(f)
+            except (OSError, ValueError):
+                names = {}
+            docsets.append({"key": entry["key"], "files": [names.get(h, h[:8]) for h in file_hashes],
+                            "index_bytes": entry["bytes"],
+                            "document_bytes": sum(documents[h]["bytes"] for h in file_hashes if h in documents),
+                            "last_used": entry["last_used"], "in_use": index_dir.resolve() in in_use})
+        docsets.sort(key=lambda docset: -docset["last_used"])
+        usage = {"dirs": directories, "docsets": docsets}
+        with self.lock:
+            self._usage, self._usage_at = usage, time.time()
+        return usage
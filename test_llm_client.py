@@ -0,0 +1,54 @@
+import threading
+import uuid
+import pytest
+from fake_llm import FakeLLMServer, fake_reply
+from llm_client import AnswerStreamHandler, LLMClient
+
+MESSAGES = [{"role": "user", "content": "Question: what does the report say?"}]
+
+@pytest.fixture
+def server():
+    server = FakeLLMServer().start()
+    yield server
+    server.shutdown()
+
+def test_streamed_reply_arrives_in_pieces(server):
+    client = LLMClient(server.url, "test-key")
+    pieces = list(client.chat(MESSAGES, stream=True))
+    assert len(pieces) > 1
+    assert "".join(pieces) == fake_reply(MESSAGES[0]["content"])
+
+def test_rate_limited_request_is_retried(server):
+    server.fail_every = 2
+    server.retry_after = 0.01
+    client = LLMClient(server.url, "test-key")
+    assert client.chat(MESSAGES).text() == fake_reply(MESSAGES[0]["content"])
+    # The second request is refused with 429 once and then sent again
+    assert client.chat(MESSAGES, stream=True).text() == fake_reply(MESSAGES[0]["content"])
+    assert server.requests == 3
+
+def test_identical_requests_in_flight_are_sent_once(server):
+    server.latency = 0.3
+    client = LLMClient(server.url, "test-key")
+    replies = []
+    threads = [threading.Thread(target=lambda: replies.append(client.chat(MESSAGES, stream=True).text()))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert replies == [fake_reply(MESSAGES[0]["content"])] * 5
+    assert server.requests == 1
+
+def test_answer_handler_ignores_prompt_text_and_untagged_runs():
+    shown = []
+    handler = AnswerStreamHandler("final_answer", shown.append)
+    tagged, untagged = uuid.uuid4(), uuid.uuid4()
+    # LLMChain reports the formatted prompt through on_text
+    handler.on_text("Prompt after formatting: ...", run_id=tagged)
+    handler.on_chat_model_start({}, [[]], run_id=tagged, tags=["final_answer"])
+    handler.on_chat_model_start({}, [[]], run_id=untagged, tags=[])
+    for token in ("The", " answer"):
+        handler.on_llm_new_token(token, run_id=tagged)
+        handler.on_llm_new_token(token, run_id=untagged)
+    assert shown == ["The", "The answer"]
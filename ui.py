@@ -6,7 +6,8 @@ import shutil
 import toml  # For manual secrets loading
 import json
 import tempfile
-from utils import clean_text, store_feedback, generate_wordcloud, export_chat_to_pdf
+from utils import clean_text, store_feedback, generate_wordcloud, request_wordcloud, export_chat_to_pdf
+from warmup import get_warmup
 
 def setup_directories():
     """Set up working directories: D: locally, cloud-compatible fallback"""
@@ -46,23 +47,85 @@ def check_disk_space(dirs):
         st.error(f"Could not check disk space: {e}")
         return None
 
-def cleanup_old_files(directory):
-    """Delete all files in directory"""
-    deleted_count = 0
-    if not os.path.exists(directory):
-        return 0
-    for filename in os.listdir(directory):
-        filepath = os.path.join(directory, filename)
-        try:
-            if os.path.isfile(filepath):
-                os.remove(filepath)
-                deleted_count += 1
-            elif os.path.isdir(filepath):
-                shutil.rmtree(filepath)
-                deleted_count += 1
-        except Exception as e:
-            st.warning(f"Could not delete {filename}: {e}")
-    return deleted_count
+def render_storage_usage(dirs):
+    """Sidebar usage of each working directory against its budget, and of each document set"""
+    from storage_manager import get_storage_manager
+    usage = get_storage_manager(dirs).usage()
+    for name, label in (("uploads_dir", "Uploads"), ("temp_dir", "Temp Files"), ("cache_dir", "Cache")):
+        used, budget = usage["dirs"][name]["bytes"], usage["dirs"][name]["budget"]
+        st.progress(min(used / budget, 1.0) if budget else 1.0,
+                    text=f"{label}: {used / (1024 * 1024):.0f} / {budget / (1024 * 1024):.0f} MB")
+    if usage["docsets"]:
+        st.write("**Document sets** (most recently used first)")
+        st.table([{"files": ", ".join(docset["files"]) or docset["key"][:8],
+                   "index MB": round(docset["index_bytes"] / (1024 * 1024), 1),
+                   "documents MB": round(docset["document_bytes"] / (1024 * 1024), 1),
+                   "last used": datetime.fromtimestamp(docset["last_used"]).strftime('%Y-%m-%d %H:%M'),
+                   "in use": "✅" if docset["in_use"] else ""} for docset in usage["docsets"]])
+
+def render_diagnostics(dirs):
+    """Sidebar panel with the last Submit's stage breakdown and process-wide stage latencies; also refreshes the export files"""
+    from metrics import metrics
+    metrics_dir = Path(os.environ.get("METRICS_DIR", dirs["base_dir"] / "metrics"))
+    snapshot = metrics.snapshot()
+    try:
+        # Every rerun of every session comes through here; the files are rewritten every few seconds at most
+        metrics.export_if_due(metrics_dir)
+    except OSError as e:
+        st.warning(f"Could not export metrics: {e}")
+    with st.sidebar.expander("🩺 Diagnostics", expanded=False):
+        if st.session_state.last_trace:
+            st.write("**Last Submit**")
+            st.table([{"stage": name, "ms": round(seconds * 1000, 1)} for name, seconds in st.session_state.last_trace])
+        if snapshot["stages"]:
+            st.write("**All stages (this process)**")
+            st.table([{"stage": name, "count": s["count"], "p50 ms": round(s["p50_ms"], 1), "p95 ms": round(s["p95_ms"], 1),
+                       "total s": round(s["total_seconds"], 2)} for name, s in snapshot["stages"].items()])
+        warmup = get_warmup().snapshot()
+        if warmup["steps"]:
+            st.write(f"**Warm-up** ({warmup['status']})")
+            st.table([{"step": step["step"], "ms": round(step["seconds"] * 1000, 1), "outcome": step["outcome"]}
+                      for step in warmup["steps"]])
+        for counter in snapshot["counters"]:
+            labels = ", ".join(f"{k}={v}" for k, v in counter["labels"].items())
+            st.write(f"{counter['name']}{f' ({labels})' if labels else ''}: {counter['value']}")
+        st.caption(f"Exported to {metrics_dir / 'metrics.prom'} and metrics.json")
+
+@st.fragment(run_every=1.0)
+def render_ingestion_progress(job):
+    """Per-file progress of the session's background ingestion job, refreshed every second without a full rerun"""
+    snapshot = job.snapshot()
+    st.write(f"**Processing documents** ({sum(1 for f in snapshot['files'] if f['status'] == 'done')}/{len(snapshot['files'])} files ready)")
+    for entry in snapshot["files"]:
+        total = entry["chunks_total"]
+        fraction = 1.0 if entry["status"] == "done" else min(entry["chunks_done"] / total, 1.0) if total else 0.0
+        counts = f"{entry['chunks_done']}/{total} chunks" if total else f"{entry['chunks_done']} chunks"
+        st.progress(fraction, text=f"{entry['file_name']}: {entry['status']} ({counts})")
+    if st.button("Cancel Processing", key=f"cancel_ingestion_{job.id}"):
+        # Files finished so far stay available; embeddings of the others are kept for the next upload
+        job.cancel()
+        st.session_state.ingest_job = None
+        st.rerun()
+    ready = job.ready()
+    # A full rerun attaches newly finished files to the chat, or shows the outcome once the job ends
+    if not job.active() or (ready is not None and st.session_state.get("ingest_job_version") != (job.id, ready["version"])):
+        st.rerun()
+
+@st.fragment(run_every=0.5)
+def render_pending_wordcloud(future):
+    """Placeholder polled while the word cloud is drawn off-thread; a full rerun shows it once ready"""
+    if future.done():
+        st.rerun()
+    st.caption("🎨 Rendering word cloud...")
+
+def render_wordcloud(future):
+    if not future.done():
+        render_pending_wordcloud(future)
+        return
+    try:
+        st.image(f"data:image/png;base64,{future.result()}", caption="Word Cloud of Last Answer")
+    except ValueError:
+        st.caption("No words to show for this answer.")
 
 def load_secrets_locally():
     """Manually load secrets from D:\RAG\venv\chatbot\.streamlit\secrets.toml for local execution"""
@@ -72,7 +135,8 @@ def load_secrets_locally():
             return toml.load(f)
     return {}
 
-def render_ui(load_and_process_documents, refine_question, clean_text, store_feedback, generate_wordcloud, export_chat_to_pdf):
+def render_ui(load_and_process_documents, refine_question, clean_text, store_feedback, generate_wordcloud, export_chat_to_pdf,
+              attach_index_artifacts=None, save_uploads=None, attach_ingestion_job=None):
     # CSS Styling
     st.markdown("""
     <style>
@@ -171,6 +235,10 @@ def render_ui(load_and_process_documents, refine_question, clean_text, store_fee
     st.title("🤖 Advanced Chat with Multiple Documents")
     st.markdown("Explore your documents (PDFs, text, images) with an interactive AI-powered chat interface!", unsafe_allow_html=True)
 
+    dirs = setup_directories()
+    # Imports the model stack and loads the embedding model and latest index while the user logs in
+    get_warmup(dirs)
+
     # Authentication (unchanged for brevity)
     if "authenticated" not in st.session_state:
         st.session_state.authenticated = False
@@ -187,6 +255,17 @@ def render_ui(load_and_process_documents, refine_question, clean_text, store_fee
                     st.error("Incorrect password!")
         return
 
+    # Deferred to here so the login screen renders before langchain, pandas and the rest load;
+    # by now the warm-up has usually imported them
+    from answer_cache import get_answer_cache, document_set_key
+    from embedding_service import get_embedding_service
+    from retrieval import FUSION_METHODS, configure_retriever, with_retriever, condense_question
+    from metrics import metrics
+    from index_registry import get_index_registry
+    from ingestion_jobs import get_ingestion_queue
+    from storage_manager import get_storage_manager
+    from llm_client import ANSWER_TAG, AnswerStreamHandler
+
     # Initialize session state
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []
@@ -212,8 +291,10 @@ def render_ui(load_and_process_documents, refine_question, clean_text, store_fee
         st.session_state.last_file_hashes = None
     if "file_context" not in st.session_state:
         st.session_state.file_context = "all uploaded files"
-
-    dirs = setup_directories()
+    if "last_trace" not in st.session_state:
+        st.session_state.last_trace = []
+    if "ingest_job" not in st.session_state:
+        st.session_state.ingest_job = None
 
     # API Key Handling
     if 'STREAMLIT_CLOUD' in os.environ:
@@ -234,16 +315,26 @@ def render_ui(load_and_process_documents, refine_question, clean_text, store_fee
             if space is not None:
                 st.info(f"Available space: {space:.1f} GB")
         if st.button("Clean Up Old Files"):
+            # Least recently used caches and indexes go first, and only down to the budgets
             with st.spinner("Cleaning up..."):
-                deleted_uploads = cleanup_old_files(dirs["uploads_dir"])
-                deleted_temp = cleanup_old_files(dirs["temp_dir"])
-                deleted_cache = cleanup_old_files(dirs["cache_dir"])
-            st.success(f"Deleted {deleted_uploads + deleted_temp + deleted_cache} files")
+                freed = get_storage_manager(dirs).enforce()
+            st.success(f"Freed {freed / (1024 * 1024):.0f} MB")
+        render_storage_usage(dirs)
         st.write(f"**Storage Location:** {dirs['base_dir']}")
         st.write(f"**Temp Files:** {dirs['temp_dir']}")
         st.write(f"**Uploads:** {dirs['uploads_dir']}")
         st.write(f"**Cache:** {dirs['cache_dir']}")
 
+        st.subheader("🧠 Answer Cache")
+        cache_stats = get_answer_cache(dirs["cache_dir"], get_embedding_service()).stats()
+        st.write(f"**Hits:** {cache_stats['hits']} ({cache_stats['near_hits']} similar) · **Misses:** {cache_stats['misses']} · **Entries:** {cache_stats['entries']}")
+
+        st.subheader("📚 Shared Indexes")
+        registry = get_index_registry()
+        index_stats = registry.stats()
+        st.write(f"**Loaded:** {len(index_stats)} · **In use:** {sum(1 for s in index_stats if s['refs'] > 0)} · "
+                 f"**Memory:** {sum(s['size_mb'] for s in index_stats):.0f} / {registry.budget_bytes / (1024 * 1024):.0f} MB")
+
     # Main UI
     with st.container():
         col1, col2 = st.columns([2, 1])
@@ -257,20 +348,73 @@ def render_ui(load_and_process_documents, refine_question, clean_text, store_fee
             st.subheader("🛠️ Quick Actions")
             if st.button("Clear Cache", key="clear_cache"):
                 try:
-                    shutil.rmtree(dirs["cache_dir"])
-                    dirs["cache_dir"].mkdir(exist_ok=True)
-                    st.success("Cache cleared successfully!")
+                    # Indexes in use and files still being processed are kept
+                    freed = get_storage_manager(dirs).clear("cache_dir")
+                    st.success(f"Cache cleared successfully! Freed {freed / (1024 * 1024):.0f} MB")
                 except Exception as e:
                     st.error(f"Error clearing cache: {e}")
+            if attach_index_artifacts is not None:
+                artifacts_dir = st.text_input("Prebuilt Index", value=os.environ.get("INDEX_ARTIFACTS_DIR", ""),
+                                              help="Directory written by build_index.py")
+                if st.button("Attach Index", key="attach_index") and artifacts_dir:
+                    try:
+                        st.session_state.llm, st.session_state.qa_chain, st.session_state.hybrid_retriever, st.session_state.file_names, chunk_count = attach_index_artifacts(artifacts_dir, groq_api_key)
+                        # Files still in the uploader would otherwise be ingested below and replace the index
+                        st.session_state.last_uploaded_files = uploaded_files
+                        if st.session_state.ingest_job is not None:
+                            st.session_state.ingest_job.cancel()
+                            st.session_state.ingest_job = None
+                        st.success(f"Attached {len(st.session_state.file_names)} files ({chunk_count} chunks).")
+                    except Exception as e:
+                        st.error(f"Could not attach index: {e}")
 
         if uploaded_files and uploaded_files != st.session_state.last_uploaded_files:
             available_space = check_disk_space(dirs)
+            if available_space and available_space < 1:
+                # Make room from the least recently used caches before refusing the upload
+                get_storage_manager(dirs).enforce()
+                available_space = check_disk_space(dirs)
             if available_space and available_space < 1:
                 st.error("Low disk space! Please clean up files before uploading new documents.")
                 return
-            st.session_state.llm, st.session_state.qa_chain, st.session_state.hybrid_retriever, st.session_state.file_names, all_chunks = load_and_process_documents(uploaded_files, groq_api_key, dirs)
+            if save_uploads is not None and attach_ingestion_job is not None:
+                # Parsing, embedding and indexing run in the background; the page stays responsive
+                previous_job = st.session_state.ingest_job
+                with st.spinner("Saving uploads..."):
+                    _, files = save_uploads(uploaded_files, dirs["uploads_dir"])
+                st.session_state.ingest_job = get_ingestion_queue().submit(files, dirs)
+                if previous_job is not None:
+                    # Superseded: it stops at its next batch and keeps what it already embedded
+                    previous_job.cancel()
+            else:
+                st.session_state.llm, st.session_state.qa_chain, st.session_state.hybrid_retriever, st.session_state.file_names, chunk_count = load_and_process_documents(uploaded_files, groq_api_key, dirs)
+                st.success(f"Processed {len(uploaded_files)} new files.")
             st.session_state.last_uploaded_files = uploaded_files
-            st.success(f"Processed {len(uploaded_files)} new files.")
+
+        job = st.session_state.ingest_job
+        if job is not None:
+            try:
+                attached = attach_ingestion_job(job, groq_api_key, dirs)
+            except Exception as e:
+                attached = None
+                st.error(f"Could not load the processed documents: {e}")
+            if attached is not None:
+                st.session_state.llm, st.session_state.qa_chain, st.session_state.hybrid_retriever, st.session_state.file_names, chunk_count = attached
+            if job.active():
+                render_ingestion_progress(job)
+            else:
+                snapshot = job.snapshot()
+                done = sum(1 for f in snapshot["files"] if f["status"] == "done")
+                if snapshot["status"] == "done":
+                    st.success(f"Processed {done} new files.")
+                elif snapshot["status"] == "failed":
+                    st.error(f"Error processing documents: {snapshot['error']}")
+                else:
+                    st.warning(f"Processing stopped after {done} of {len(snapshot['files'])} files.")
+                for entry in snapshot["files"]:
+                    if entry["error"]:
+                        st.warning(f"Could not process {entry['file_name']}: {entry['error']}")
+                st.session_state.ingest_job = None
 
         if st.session_state.file_names:
             st.subheader("💬 Chat with Your Documents")
@@ -288,39 +432,75 @@ def render_ui(load_and_process_documents, refine_question, clean_text, store_fee
 
             if st.button("🚀 Submit", key="submit_question"):
                 if user_question and user_question.strip():
-                    with st.spinner("Generating answer..."):
+                    with st.spinner("Generating answer..."), metrics.trace() as submit_spans, metrics.span("submit.total"):
+                        st.session_state.last_trace = submit_spans
                         try:
-                            refined_q = refine_question(user_question, st.session_state.llm, selected_files, st.session_state.file_names)
-                            # Use the existing QA chain with the original retriever
-                            result = st.session_state.qa_chain({"question": refined_q})
-                            answer = result.get("answer", "").strip() or "No answer generated."
-
-                            if "no relevant content" in answer.lower() or "not in the documents" in answer.lower():
-                                st.warning("No answer found in documents. Searching external sources...")
-                                external_prompt = f"Search X and the web for: {refined_q}"
-                                external_answer = st.session_state.llm.invoke(external_prompt).content.strip()
-                                answer = f"{answer}\n\n**External Search Result:** {external_answer}"
+                            answer_cache = get_answer_cache(dirs["cache_dir"], get_embedding_service())
+                            dense_weight = st.session_state.get("retrieval_dense_weight", 0.5)
+                            retrieval = {"k": st.session_state.get("retrieval_k", 3), "weights": [dense_weight, 1 - dense_weight],
+                                         "fusion": st.session_state.get("retrieval_fusion", "rrf")}
+                            docset = document_set_key(st.session_state.last_file_hashes, selected_files, retrieval)
+                            # A follow-up ("why?", "tell me more") is cached under its standalone form,
+                            # which is also what the chain answers below
+                            standalone_question = condense_question(st.session_state.qa_chain, user_question)
+                            with metrics.span("submit.cache_lookup"):
+                                answer, question_vector = answer_cache.lookup(docset, standalone_question)
+                            metrics.increment("answer_cache_lookups_total", result="miss" if answer is None else "hit")
+                            # Filled token by token while the answer is generated, then with the final answer
+                            answer_placeholder = st.empty()
+                            show_partial = lambda text: answer_placeholder.markdown(
+                                f"<div class='chat-message bot-message'>{text}▌</div>", unsafe_allow_html=True)
+                            if answer is not None:
+                                # Keep the conversation memory in step even when the LLM is skipped
+                                st.session_state.qa_chain.memory.save_context({"question": user_question}, {"answer": answer})
+                                st.caption("⚡ Answered from cache")
+                            else:
+                                refined_q = refine_question(standalone_question, st.session_state.llm, selected_files, st.session_state.file_names)
+                                # This request's files and retrieval settings; the copy shares the session's memory and LLM
+                                selected_hashes = [h for h, doc in st.session_state.processed_docs.items() if doc["file_name"] in selected_files]
+                                scoped_retriever = configure_retriever(st.session_state.hybrid_retriever, selected_hashes, **retrieval)
+                                qa_chain = with_retriever(st.session_state.qa_chain, scoped_retriever, condense=False)
+                                with metrics.span("submit.qa"):
+                                    result = qa_chain({"question": refined_q}, callbacks=[AnswerStreamHandler(ANSWER_TAG, show_partial)])
+                                answer = result.get("answer", "").strip() or "No answer generated."
+
+                                if "no relevant content" in answer.lower() or "not in the documents" in answer.lower():
+                                    st.warning("No answer found in documents. Searching external sources...")
+                                    external_prompt = f"Search X and the web for: {refined_q}"
+                                    external_answer = ""
+                                    with metrics.span("submit.external"):
+                                        for chunk in st.session_state.llm.stream(external_prompt):
+                                            external_answer += chunk.content
+                                            show_partial(f"{answer}\n\n**External Search Result:** {external_answer}")
+                                    external_answer = external_answer.strip()
+                                    answer = f"{answer}\n\n**External Search Result:** {external_answer}"
+                                answer_cache.store(docset, standalone_question, answer, question_vector)
+                            metrics.increment("submits_total")
 
                             st.session_state.chat_history.append(("You", f"Question about {file_context}: {user_question}", datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
                             st.session_state.chat_history.append(("Bot", answer, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
                             st.session_state.last_answer = answer
                             st.session_state.user_question = ""
                             st.success("Answer generated!")
-                            st.markdown(f"<div class='chat-message bot-message'>{answer}</div>", unsafe_allow_html=True)
+                            answer_placeholder.markdown(f"<div class='chat-message bot-message'>{answer}</div>", unsafe_allow_html=True)
                         except Exception as e:
+                            metrics.increment("submit_errors_total")
                             st.error(f"Error generating answer: {str(e)}")
                             st.session_state.last_answer = f"Error: {str(e)}"
 
+            # Start rendering the word cloud now; it is drawn off-thread while the rest of the page renders
+            wordcloud_future = (request_wordcloud(st.session_state.last_answer, generate_wordcloud)
+                                if st.session_state.last_answer else None)
+
             # Rest of the UI (chat history, feedback, etc.) remains largely unchanged for brevity
             with st.expander("⚙️ Advanced Settings", expanded=False):
                 st.write("Adjust retrieval parameters or model settings here.")
-                k_value = st.slider("Number of documents to retrieve (k)", 1, 10, 3)
-                if st.session_state.hybrid_retriever and hasattr(st.session_state.hybrid_retriever, 'retrievers'):
-                    for retriever in st.session_state.hybrid_retriever.retrievers:
-                        if hasattr(retriever, 'search_kwargs'):
-                            retriever.search_kwargs["k"] = k_value
-                        if hasattr(retriever, 'k'):
-                            retriever.k = k_value
+                # Read by the next Submit; the shared retriever itself is never changed
+                st.slider("Number of documents to retrieve (k)", 1, 10, 3, key="retrieval_k")
+                st.slider("Dense vs. keyword weight", 0.0, 1.0, 0.5, 0.05, key="retrieval_dense_weight",
+                          help="1.0 uses only the embedding search, 0.0 only BM25")
+                st.selectbox("Score fusion", FUSION_METHODS, key="retrieval_fusion",
+                             format_func=lambda m: {"rrf": "Reciprocal rank", "weighted": "Weighted scores"}[m])
 
             st.subheader("📜 Chat History")
             chat_container = st.container(height=300)
@@ -351,6 +531,9 @@ def render_ui(load_and_process_documents, refine_question, clean_text, store_fee
                 st.session_state.chat_history = []
                 st.session_state.chat_deleted = set()
                 st.session_state.last_answer = None
+                if st.session_state.qa_chain is not None:
+                    # Otherwise the next question is still read as a follow-up of the cleared ones
+                    st.session_state.qa_chain.memory.clear()
                 st.success("Chat history cleared!")
                 st.rerun()
 
@@ -374,9 +557,7 @@ def render_ui(load_and_process_documents, refine_question, clean_text, store_fee
                                          st.session_state.last_answer, "negative", dirs["base_dir"])
                             st.success("Thanks for your feedback!")
                     st.subheader("📊 Answer Insights")
-                    wordcloud_text = st.session_state.last_answer
-                    img_str = generate_wordcloud(wordcloud_text)
-                    st.image(f"data:image/png;base64,{img_str}", caption="Word Cloud of Last Answer")
+                    render_wordcloud(wordcloud_future)
 
             chat_history_path = dirs["base_dir"] / "chat_history.json"
             with open(chat_history_path, "w", encoding="utf-8") as f:
@@ -389,3 +570,5 @@ def render_ui(load_and_process_documents, refine_question, clean_text, store_fee
             )
 
             st.info(f"Processed {len(st.session_state.file_names)} files. Storage location: {dirs['base_dir']}. Last update: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    render_diagnostics(dirs)
@@ -1,60 +1,61 @@
 import re
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 from datetime import datetime
 import os
 from pathlib import Path
-from wordcloud import WordCloud
-import matplotlib.pyplot as plt
 from io import BytesIO
 import base64
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph
-from reportlab.lib.styles import getSampleStyleSheet
-# from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 import json
 import tempfile
+from feedback_store import get_feedback_store
+
+WORDCLOUD_CACHE_SIZE = int(os.environ.get("WORDCLOUD_CACHE_SIZE", "64"))
+_wordcloud_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="wordcloud")
+_wordclouds = OrderedDict()  # answer hash -> Future of the base64 PNG
+_wordclouds_lock = threading.Lock()
 
 def clean_text(text):
     return re.sub(r'[\u0000-\u001F\u007F-\u009F\uD800-\uDFFF]', '', text)
 
 def store_feedback(question, answer, feedback, base_dir):
-    feedback_dir = base_dir / "feedback"
-    feedback_dir.mkdir(exist_ok=True)
-    feedback_file = feedback_dir / "feedback_log.json"
-    
-    feedback_data = {
-        "question": question,
-        "answer": answer,
-        "feedback": feedback,
-        "timestamp": datetime.now().isoformat()
-    }
-    
     try:
-        if feedback_file.exists():
-            with open(feedback_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        else:
-            data = []
-        data.append(feedback_data)
-        with open(feedback_file, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        get_feedback_store(base_dir).append(question, answer, feedback)
     except Exception as e:
         print(f"Could not save feedback: {e}")
 
 def generate_wordcloud(text):
-    wordcloud = WordCloud(width=800, height=400, background_color="white").generate(text)
-    fig, ax = plt.subplots(figsize=(10, 5))
-    ax.imshow(wordcloud, interpolation="bilinear")
-    ax.axis("off")
+    """Base64 PNG of the word cloud of text, encoded straight from WordCloud's PIL image"""
+    # wordcloud pulls in matplotlib; imported on first use so startup does not pay for it
+    from wordcloud import WordCloud
+    image = WordCloud(width=800, height=400, background_color="white").generate(text).to_image()
     buf = BytesIO()
-    plt.savefig(buf, format="png")
-    buf.seek(0)
-    img_str = base64.b64encode(buf.getvalue()).decode("utf-8")
-    plt.close()
-    return img_str
+    image.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+def request_wordcloud(text, render=generate_wordcloud):
+    """
+    Future resolving to render(text), by default generate_wordcloud, drawn on a background thread.
+    Results are kept in an LRU keyed by the text's hash, so reruns showing the same answer reuse them.
+    """
+    key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    with _wordclouds_lock:
+        future = _wordclouds.get(key)
+        if future is None or (future.done() and future.exception() is not None):
+            future = _wordcloud_pool.submit(render, text)
+            _wordclouds[key] = future
+        _wordclouds.move_to_end(key)
+        while len(_wordclouds) > WORDCLOUD_CACHE_SIZE:
+            _wordclouds.popitem(last=False)
+    return future
 
 def export_chat_to_pdf(base_dir):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph
+    from reportlab.lib.styles import getSampleStyleSheet
     pdf_path = base_dir / f"chat_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
     doc = SimpleDocTemplate(str(pdf_path), pagesize=letter)
     styles = getSampleStyleSheet()
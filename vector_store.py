@@ -0,0 +1,378 @@
+import json
+import os
+from pathlib import Path
+import numpy as np
+from langchain.schema import Document
+
+DATA_FILES = ("vectors.f32", "norms.f32", "chunks.jsonl", "offsets.u64")
+# "auto" picks by corpus size: exact flat search, then HNSW, then IVF; "flat", "hnsw", "ivf" and "ivfpq" force a type
+VECTOR_INDEX_TYPE = os.environ.get("VECTOR_INDEX_TYPE", "auto")
+# Product quantization shrinks the ANN index to ~1/8 of the float32 vectors; the vectors file is kept for re-ranking
+VECTOR_INDEX_PQ = os.environ.get("VECTOR_INDEX_PQ", "0") == "1"
+HNSW_MIN_ROWS = int(os.environ.get("HNSW_MIN_ROWS", "50000"))
+IVF_MIN_ROWS = int(os.environ.get("IVF_MIN_ROWS", "1000000"))
+ANN_TARGET_RECALL = float(os.environ.get("ANN_TARGET_RECALL", "0.95"))
+ANN_RECALL_K = 10
+ANN_TUNING_QUERIES = 200
+ADD_BATCH_ROWS = 100_000
+
+def choose_index_type(rows, index_type=None, pq=None):
+    """Index type for a corpus of rows vectors: flat, hnsw, ivf or ivfpq"""
+    index_type = index_type or VECTOR_INDEX_TYPE
+    pq = VECTOR_INDEX_PQ if pq is None else pq
+    if index_type == "auto":
+        if rows < HNSW_MIN_ROWS:
+            return "flat"
+        index_type = "hnsw" if rows < IVF_MIN_ROWS else "ivf"
+    if index_type not in ("flat", "hnsw", "ivf", "ivfpq"):
+        raise ValueError(f"Unknown vector index type: {index_type}")
+    if pq and index_type != "flat":
+        return "ivfpq"
+    return index_type
+
+def create_data_files(path, generation):
+    """Empty data files for one generation of a VectorIndex; offsets start with the 0 of the first record"""
+    for name in DATA_FILES[:3]:
+        open(Path(path) / f"{name}-{generation}", "wb").close()
+    np.zeros(1, dtype=np.uint64).tofile(Path(path) / f"offsets.u64-{generation}")
+
+class VectorIndex:
+    """
+    L2 vector index plus chunk store, kept in plain files that are memory-mapped.
+
+    Rows of one file are contiguous, so every file is a row range. Vectors and their squared
+    norms are raw float32 arrays, chunk records are JSON lines located through a uint64 offset
+    array, and meta.json lists the row range of each file. Opening an index reads meta.json
+    only: nothing is unpickled, vectors are paged in by the OS on first use, and worker
+    processes that open the same index share those pages. Chunk texts are decoded per hit.
+
+    Files are appended in place; removed files are tombstoned and the data is rewritten
+    into a new generation of files once a quarter of the rows are dead.
+
+    Small corpora are searched exactly. Above HNSW_MIN_ROWS an approximate FAISS index
+    (HNSW, IVF or IVF-PQ, see choose_index_type) is kept next to the data files, with row
+    numbers as ids; its candidates are re-ranked exactly against the memory-mapped vectors.
+    Its search parameter is tuned on ingestion for ANN_TARGET_RECALL and the measured
+    recall@k against flat search is stored in meta["ann"].
+    """
+
+    def __init__(self, path, meta):
+        self.path = Path(path)
+        self.meta = meta
+        self._ann = None
+        self._map()
+
+    @classmethod
+    def open(cls, path, signature=None):
+        """Open the index at path, or start an empty one if it is missing or was built with another signature"""
+        path = Path(path)
+        try:
+            with open(path / "meta.json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+        if meta is None or (signature is not None and meta["signature"] != signature):
+            path.mkdir(parents=True, exist_ok=True)
+            generation = meta["generation"] + 1 if meta else 0
+            meta = {"signature": signature, "dim": 0, "rows": 0, "generation": generation, "files": {}, "dead": []}
+            create_data_files(path, generation)
+            index = cls(path, meta)
+            index.save()
+            return index
+        index = cls(path, meta)
+        if meta.get("ann"):
+            # Opened now rather than at the first search: a later update of the directory may compact
+            # it, which removes this generation's ANN file while a snapshot is still being served
+            index._load_ann()
+        return index
+
+    def _data_path(self, name, generation=None):
+        generation = self.meta["generation"] if generation is None else generation
+        return self.path / f"{name}-{generation}"
+
+    def _map(self):
+        rows, dim = self.meta["rows"], self.meta["dim"]
+        if rows:
+            self.vectors = np.memmap(self._data_path("vectors.f32"), dtype=np.float32, mode="r", shape=(rows, dim))
+            self.norms = np.memmap(self._data_path("norms.f32"), dtype=np.float32, mode="r", shape=(rows,))
+            self.chunk_data = np.memmap(self._data_path("chunks.jsonl"), dtype=np.uint8, mode="r")
+        else:
+            self.vectors = np.zeros((0, dim), dtype=np.float32)
+            self.norms = np.zeros(0, dtype=np.float32)
+            self.chunk_data = np.zeros(0, dtype=np.uint8)
+        self.offsets = np.memmap(self._data_path("offsets.u64"), dtype=np.uint64, mode="r", shape=(rows + 1,))
+        files = sorted(self.meta["files"].items(), key=lambda item: item[1][0])
+        self._file_hashes = [file_hash for file_hash, _ in files]
+        self._file_starts = np.asarray([start for _, (start, _) in files], dtype=np.int64)
+
+    def save(self):
+        tmp_path = self.path / f"meta.json.tmp{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.path / "meta.json")
+
+    def __len__(self):
+        return sum(count for _, count in self.meta["files"].values())
+
+    def file_hashes(self):
+        return list(self.meta["files"])
+
+    def nbytes(self):
+        """Size of the data files, i.e. the memory the index occupies once fully paged in"""
+        size = self.vectors.nbytes + self.norms.nbytes + self.chunk_data.nbytes + self.offsets.nbytes
+        if self.meta.get("ann"):
+            size += os.path.getsize(self._data_path("ann.faiss"))
+        return size
+
+    def _truncate_to_meta(self):
+        """Drop bytes left behind by an add_file that failed before meta.json was saved"""
+        rows, dim = self.meta["rows"], self.meta["dim"]
+        sizes = {"vectors.f32": rows * dim * 4, "norms.f32": rows * 4, "offsets.u64": (rows + 1) * 8,
+                 "chunks.jsonl": int(self.offsets[-1])}
+        for name, size in sizes.items():
+            if os.path.getsize(self._data_path(name)) != size:
+                os.truncate(self._data_path(name), size)
+
+    def add_file(self, file_hash, batches):
+        """Append one file from an iterable of (chunks, vectors) batches"""
+        self._truncate_to_meta()
+        start = self.meta["rows"]
+        end_offset = int(self.offsets[-1])
+        with open(self._data_path("vectors.f32"), "ab") as vectors_file, \
+                open(self._data_path("norms.f32"), "ab") as norms_file, \
+                open(self._data_path("chunks.jsonl"), "ab") as chunks_file, \
+                open(self._data_path("offsets.u64"), "ab") as offsets_file:
+            for chunks, vectors in batches:
+                vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+                if not len(chunks):
+                    continue
+                self.meta["dim"] = vectors.shape[1]
+                vectors_file.write(vectors.tobytes())
+                norms_file.write((vectors * vectors).sum(axis=1).astype(np.float32).tobytes())
+                ends = []
+                for chunk in chunks:
+                    record = (json.dumps({"page_content": chunk.page_content, "metadata": chunk.metadata}, ensure_ascii=False) + "\n").encode("utf-8")
+                    chunks_file.write(record)
+                    end_offset += len(record)
+                    ends.append(end_offset)
+                offsets_file.write(np.asarray(ends, dtype=np.uint64).tobytes())
+                self.meta["rows"] += len(chunks)
+        self.meta["files"][file_hash] = [start, self.meta["rows"] - start]
+        self._map()
+        self._ann = None
+
+    def remove_file(self, file_hash):
+        if file_hash not in self.meta["files"]:
+            return
+        self.meta["dead"].append(self.meta["files"].pop(file_hash))
+        if sum(count for _, count in self.meta["dead"]) > 0.25 * self.meta["rows"]:
+            self.compact()
+        else:
+            self._map()
+
+    def compact(self):
+        """Rewrite the live rows into the next generation of data files and drop the old ones"""
+        old_generation = self.meta["generation"]
+        new_generation = old_generation + 1
+        create_data_files(self.path, new_generation)
+        files, row, end_offset = {}, 0, 0
+        with open(self._data_path("vectors.f32", new_generation), "ab") as vectors_file, \
+                open(self._data_path("norms.f32", new_generation), "ab") as norms_file, \
+                open(self._data_path("chunks.jsonl", new_generation), "ab") as chunks_file, \
+                open(self._data_path("offsets.u64", new_generation), "ab") as offsets_file:
+            for file_hash, (start, count) in sorted(self.meta["files"].items(), key=lambda item: item[1][0]):
+                vectors_file.write(np.ascontiguousarray(self.vectors[start:start + count]).tobytes())
+                norms_file.write(np.ascontiguousarray(self.norms[start:start + count]).tobytes())
+                first, last = int(self.offsets[start]), int(self.offsets[start + count])
+                chunks_file.write(self.chunk_data[first:last].tobytes())
+                offsets_file.write((self.offsets[start + 1:start + count + 1] - np.uint64(first) + np.uint64(end_offset)).astype(np.uint64).tobytes())
+                files[file_hash] = [row, count]
+                row += count
+                end_offset += last - first
+        # Row numbers changed, so the ANN index of the old generation is useless; update_ann rebuilds it
+        self.meta.update({"generation": new_generation, "rows": row, "files": files, "dead": [], "ann": None})
+        self._map()
+        self._ann = None
+        self.save()
+        for name in DATA_FILES + ("ann.faiss",):
+            try:
+                os.remove(self._data_path(name, old_generation))
+            except OSError:
+                pass  # Still mapped by a reader (Windows) or never built; it is ignored from now on
+
+    def _iter_rows(self, start=0):
+        for first in range(start, self.meta["rows"], ADD_BATCH_ROWS):
+            yield np.ascontiguousarray(self.vectors[first:first + ADD_BATCH_ROWS])
+
+    def _build_ann(self, index_type):
+        import faiss
+        rows, dim = self.meta["rows"], self.meta["dim"]
+        if index_type == "hnsw":
+            ann = faiss.IndexHNSWFlat(dim, 32)
+            ann.hnsw.efConstruction = 80
+        else:
+            nlist = int(min(max(4 * np.sqrt(rows), 16), 65536))
+            quantizer = faiss.IndexFlatL2(dim)
+            if index_type == "ivfpq":
+                # 8 dimensions per 8-bit sub-quantizer: 48 bytes per vector for MiniLM instead of 1536
+                m = next(m for m in range(max(dim // 8, 1), 0, -1) if dim % m == 0)
+                ann = faiss.IndexIVFPQ(quantizer, dim, nlist, m, 8)
+            else:
+                ann = faiss.IndexIVFFlat(quantizer, dim, nlist)
+            sample = np.random.default_rng(0).choice(rows, size=min(rows, max(64 * nlist, 50_000)), replace=False)
+            ann.train(np.ascontiguousarray(self.vectors[np.sort(sample)]))
+        for batch in self._iter_rows():
+            ann.add(batch)
+        return ann
+
+    def _tune_ann(self, ann, index_type):
+        """Smallest efSearch / nprobe whose recall@k against exact search reaches ANN_TARGET_RECALL"""
+        import faiss
+        rows, k = self.meta["rows"], min(ANN_RECALL_K, self.meta["rows"])
+        rng = np.random.default_rng(0)
+        # Midpoints of random row pairs: realistic queries that are not themselves indexed rows
+        pairs = rng.integers(0, rows, size=(ANN_TUNING_QUERIES, 2))
+        queries = np.ascontiguousarray((self.vectors[pairs[:, 0]] + self.vectors[pairs[:, 1]]) / 2, dtype=np.float32)
+        _, truth = faiss.knn(queries, np.asarray(self.vectors), k)
+        if index_type == "hnsw":
+            # Below the over-fetch depth efSearch cannot change the candidate list
+            fetch = self._ann_fetch(ann, k)
+            name, values = "efSearch", [e for e in (16, 32, 64, 128, 256, 512) if e >= fetch] or [fetch]
+        else:
+            name, values = "nprobe", [p for p in (1, 2, 4, 8, 16, 32, 64, 128, 256) if p <= ann.nlist] or [ann.nlist]
+        for value in values:
+            found = [self._ann_search(ann, {name: value}, query, k, None) for query in queries]
+            recall = float(np.mean([len({r for r, _ in hits} & set(expected.tolist())) / k
+                                    for hits, expected in zip(found, truth)]))
+            if recall >= ANN_TARGET_RECALL:
+                break
+        return {name: value}, recall
+
+    def update_ann(self):
+        """
+        Bring the ANN index in line with the data files after files were added or removed.
+        New rows are added incrementally; the index is rebuilt and re-tuned when the data was
+        compacted, the chosen type changed or the corpus doubled since it was trained.
+        """
+        import faiss
+        previous = self.meta.get("ann")
+        index_type = choose_index_type(len(self))
+        if index_type == "flat":
+            self.meta["ann"] = None
+            return
+        if previous and previous["type"] == index_type and previous["generation"] == self.meta["generation"] \
+                and self.meta["rows"] < 2 * previous["trained_rows"]:
+            if previous["rows"] == self.meta["rows"]:
+                return
+            ann = faiss.read_index(str(self._data_path("ann.faiss")))
+            for batch in self._iter_rows(previous["rows"]):
+                ann.add(batch)
+            trained_rows = previous["trained_rows"]
+        else:
+            ann = self._build_ann(index_type)
+            trained_rows = self.meta["rows"]
+        params, recall = self._tune_ann(ann, index_type)
+        tmp_path = self.path / f"ann.faiss.tmp{os.getpid()}"
+        faiss.write_index(ann, str(tmp_path))
+        os.replace(tmp_path, self._data_path("ann.faiss"))
+        self.meta["ann"] = {"type": index_type, "generation": self.meta["generation"], "rows": self.meta["rows"],
+                            "trained_rows": trained_rows, "params": params, f"recall@{ANN_RECALL_K}": recall}
+        self._ann = ann
+
+    def _load_ann(self):
+        """The ANN index of this generation, or None if its file is gone"""
+        if self._ann is None:
+            import faiss
+            path = str(self._data_path("ann.faiss"))
+            try:
+                # Memory-mapped like the vectors, so sessions and processes share one copy
+                self._ann = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                try:
+                    self._ann = faiss.read_index(path)
+                except RuntimeError:
+                    return None
+        return self._ann
+
+    @staticmethod
+    def _ann_fetch(ann, k):
+        """Candidates fetched from the ANN index for an exact re-rank of the top k"""
+        import faiss
+        # PQ distances are coarse, so the exact re-rank needs a deeper candidate list
+        return max(16 * k, 128) if isinstance(ann, faiss.IndexIVFPQ) else max(4 * k, 32)
+
+    def _ann_search(self, ann, params, query, k, ranges):
+        """Over-fetch from the ANN index within ranges (None = every row) and re-rank exactly"""
+        import faiss
+        fetch = self._ann_fetch(ann, k)
+        selector = bitmap = None
+        if ranges is not None:
+            mask = np.zeros(self.meta["rows"], dtype=bool)
+            for start, count in ranges:
+                mask[start:start + count] = True
+            bitmap = np.packbits(mask, bitorder="little")
+            selector = faiss.IDSelectorBitmap(bitmap)
+        if "efSearch" in params:
+            search_params = faiss.SearchParametersHNSW(efSearch=params["efSearch"], sel=selector)
+        else:
+            search_params = faiss.SearchParametersIVF(nprobe=params["nprobe"], sel=selector)
+        _, ids = ann.search(query[None, :], fetch, params=search_params)
+        del bitmap  # the selector only borrows the bitmap, so it has to outlive the search
+        # A snapshot opened before rows were appended to its directory ignores the ANN ids of those rows
+        rows = np.sort(ids[0][(ids[0] >= 0) & (ids[0] < self.meta["rows"])])
+        distances = self.norms[rows] - 2 * (self.vectors[rows] @ query) + float(query @ query)
+        return self._top_k(rows, distances, k)
+
+    def _ranges(self, groups=None):
+        if groups is None:
+            return list(self.meta["files"].values())
+        return [self.meta["files"][g] for g in groups if g in self.meta["files"]]
+
+    def search(self, vector, k, groups=None):
+        """Return up to k (row, squared L2 distance) pairs, nearest first, optionally only within some files"""
+        query = np.asarray(vector, dtype=np.float32)
+        whole = groups is None and not self.meta["dead"]
+        if whole:
+            ranges = [(0, self.meta["rows"])] if self.meta["rows"] else []
+        else:
+            ranges = self._ranges(groups)
+        ann = self.meta.get("ann")
+        # A narrow file selection is cheaper to scan than to filter inside the ANN index
+        if ann and sum(count for _, count in ranges) >= HNSW_MIN_ROWS:
+            ann_index = self._load_ann()
+            # Without its ANN file (removed by a compaction) a snapshot still answers, by exact search
+            if ann_index is not None:
+                return self._ann_search(ann_index, ann["params"], query, k, None if whole else ranges)
+        return self._exact(query, k, ranges)
+
+    def _exact(self, query, k, ranges):
+        """Exact scan of row ranges"""
+        rows, distances = [], []
+        for start, count in ranges:
+            # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2; the last term does not change the ranking
+            distances.append(self.norms[start:start + count] - 2 * (self.vectors[start:start + count] @ query))
+            rows.append(np.arange(start, start + count))
+        if not rows:
+            return []
+        return self._top_k(np.concatenate(rows), np.concatenate(distances) + float(query @ query), k)
+
+    @staticmethod
+    def _top_k(rows, distances, k):
+        if len(rows) > k:
+            top = np.argpartition(distances, k)[:k]
+            rows, distances = rows[top], distances[top]
+        order = np.argsort(distances, kind="stable")
+        return [(int(rows[i]), float(distances[i])) for i in order]
+
+    def chunk_id(self, row):
+        position = int(np.searchsorted(self._file_starts, row, side="right")) - 1
+        file_hash = self._file_hashes[position]
+        return f"{file_hash}:{row - self.meta['files'][file_hash][0]}"
+
+    def get_document(self, row):
+        """Decode one chunk record; accepts a row number or a "<file_hash>:<n>" chunk id"""
+        if isinstance(row, str):
+            file_hash, number = row.rsplit(":", 1)
+            row = self.meta["files"][file_hash][0] + int(number)
+        record = json.loads(self.chunk_data[int(self.offsets[row]):int(self.offsets[row + 1])].tobytes())
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
@@ -0,0 +1,119 @@
+import importlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# Warm the process up on a background thread while the login screen is shown
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "1") == "1"
+# Imported by the warm-up in this order; processing alone pulls in langchain, pandas and the loaders
+WARMUP_MODULES = ("processing", "retrieval", "answer_cache", "ingestion_jobs", "storage_manager", "llm_client")
+WARMUP_QUERY = "warm up"
+
+_warmup = None
+_warmup_lock = threading.Lock()
+
+def get_warmup(dirs=None):
+    """Return the process-wide Warmup, started on first call unless WARMUP_ON_START is off"""
+    global _warmup
+    with _warmup_lock:
+        if _warmup is None:
+            _warmup = Warmup(dirs)
+            if WARMUP_ON_START:
+                _warmup.start()
+        return _warmup
+
+def lazy_import(module_name, name):
+    """Stand-in for module_name.name that imports the module at its first call"""
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), name)(*args, **kwargs)
+    call.__name__ = name
+    return call
+
+class Warmup:
+    """
+    Background warm-up of a fresh process: imports WARMUP_MODULES, loads the embedding model
+    by embedding one query, then leases the indexes of INDEX_ARTIFACTS_DIR or else of the most
+    recently used document set and searches them once, which loads the FAISS index and pages
+    the data in. The lease is released right away; the indexes stay in the index registry for
+    the first session that asks for them. Each step is timed into steps and into the metrics
+    as warmup.<step>.
+    """
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+        self.status = "disabled"  # running, then done
+        self.steps = []  # {"step", "seconds", "outcome"}
+        self.lock = threading.Lock()
+        self._vector = None
+
+    def start(self):
+        self.status = "running"
+        threading.Thread(target=self.run, name="warmup", daemon=True).start()
+
+    def snapshot(self):
+        with self.lock:
+            return {"status": self.status, "steps": [dict(step) for step in self.steps]}
+
+    def _step(self, name, function):
+        started = time.perf_counter()
+        try:
+            outcome = function() or "ok"
+        except Exception as e:
+            outcome = f"failed: {e}"
+        with self.lock:
+            self.steps.append({"step": name, "seconds": time.perf_counter() - started, "outcome": outcome})
+
+    def run(self):
+        for module_name in WARMUP_MODULES:
+            self._step(f"import.{module_name}", lambda: importlib.import_module(module_name) and None)
+        self._step("import.faiss", self._import_faiss)
+        self._step("embedding_model", self._load_model)
+        self._step("index", self._load_index)
+        from metrics import metrics
+        with self.lock:
+            self.status = "done"
+            steps = list(self.steps)
+        for step in steps:
+            metrics.observe(f"warmup.{step['step']}", step["seconds"])
+
+    @staticmethod
+    def _import_faiss():
+        try:
+            import faiss  # noqa: F401
+        except ImportError:
+            # Optional: without it vector search is exact
+            return "skipped: faiss not installed"
+
+    def _load_model(self):
+        from embedding_service import get_embedding_service
+        self._vector = get_embedding_service().embed_query(WARMUP_QUERY)
+
+    def _latest_document_set(self):
+        """File hashes of the most recently used index directory in the cache, or None"""
+        index_dirs = [path for path in (Path(self.dirs["cache_dir"]) / "indexes").glob("*") if path.is_dir()]
+        for index_dir in sorted(index_dirs, key=lambda path: path.stat().st_mtime, reverse=True):
+            try:
+                with open(index_dir / "vector_index" / "meta.json", "r", encoding="utf-8") as f:
+                    return list(json.load(f)["files"])
+            except (OSError, ValueError, KeyError):
+                continue
+        return None
+
+    def _load_index(self):
+        from processing import lease_document_set, load_index_artifacts
+        artifacts_dir = os.environ.get("INDEX_ARTIFACTS_DIR")
+        if artifacts_dir:
+            lease, _ = load_index_artifacts(artifacts_dir)
+        else:
+            file_hashes = self._latest_document_set() if self.dirs else None
+            if not file_hashes:
+                return "skipped: no index yet"
+            lease = lease_document_set(file_hashes, self.dirs["cache_dir"])
+        try:
+            if self._vector is not None:
+                lease.vector_index.search(self._vector, 1)
+            lease.bm25_index.search(WARMUP_QUERY, 1)
+        finally:
+            lease.release()